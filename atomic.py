@@ -0,0 +1,19 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w", encoding="utf-8"):
+    """Open a temporary file that replaces path only once fully written.
+
+    A job killed while writing leaves path untouched instead of truncated.
+    encoding only applies to text modes.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, mode, encoding=None if "b" in mode else encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,711 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import statistics
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+import torch
+import generate
+import transformers
+from corpus import PROMPT_DELIMITERS, get_prompt, load_corpus
+from generate import (
+    GEN_TYPES,
+    LEVELS,
+    TEXT_TYPES,
+    PromptCache,
+    Telemetry,
+    generate_with_logprobs,
+    get_model_name,
+    get_output_paths,
+    get_peak_rss,
+    load_model,
+    save_results,
+)
+from plot import (
+    calculate_confidence_metrics,
+    extract_pair_data,
+    plot_pair_probabilities,
+    plot_surprisal_context,
+    select_ratio_points,
+)
+from store import load_log_files
+
+BENCH_DIR = "benchmarks"
+MODEL_DIR = os.path.join(BENCH_DIR, "tiny_model")
+SYNTHETIC_DIR = os.path.join(BENCH_DIR, "synthetic")
+BENCH_RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+# level, text_type and gen_type of the benchmark prompts
+BENCH_CONFIGURATION = ("ce1", "literature", "continuation")
+# keys identifying a case, to match the cases of two runs
+GENERATION_CASE = ["prompt_len", "max_new_tokens", "top_k", "batch_size", "capture"]
+ANALYSIS_CASE = ["files", "steps", "top_k", "stage"]
+# models of the plots, by the name of their results folder
+ANALYSIS_MODELS = {
+    "llama": "Llama-3.2-3B",
+    "mistral": "Mistral-7B-Instruct-v0.3",
+    "qwen": "Qwen2.5-7B-Instruct",
+}
+ANALYSIS_STAGES = [
+    "load_log_files",
+    "extract_pair_data",
+    "calculate_confidence_metrics",
+    "select_ratio_points",
+    "plot_pair_probabilities",
+    "plot_surprisal_context",
+]
+# tokens drawn far more often than the rest of the synthetic vocabulary
+SYNTHETIC_PAIRS = [
+    {"il": "elle"},
+    {"ils": "elles"},
+    {"le": "la"},
+    {"un": "une"},
+]
+
+
+def get_corpus_texts():
+    """Return every corpus text, by text id."""
+    texts = {}
+    for level in LEVELS:
+        for text_type in TEXT_TYPES:
+            texts.update(load_corpus(level, text_type))
+    return texts
+
+
+def build_tiny_model(
+    model_dir=MODEL_DIR,
+    vocab_size=4000,
+    hidden_size=64,
+    num_layers=2,
+    seed=0,
+):
+    """Save a small randomly initialized causal LM and its tokenizer.
+
+    The tokenizer is a byte-level BPE trained on the corpus texts, so that
+    prompts are split about as finely as by the real tokenizers, and the
+    model has the Llama architecture of the models studied. Nothing is
+    downloaded, and the same seed gives the same weights.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    print(f"Building a tiny model in {model_dir}...")
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(
+        get_corpus_texts().values(),
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=["<s>", "</s>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+            show_progress=False,
+        ),
+    )
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        bos_token="<s>",
+        eos_token="</s>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+    torch.manual_seed(seed)
+    config = transformers.LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    model = transformers.LlamaForCausalLM(config)
+
+    tokenizer.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+
+
+def get_bench_prompts(tokenizer, texts, prompt_len, batch_size):
+    """Build batch_size prompts of generate.py around prompt_len corpus tokens.
+
+    Like those of generate.py, the prompts share their instruction and
+    few-shot examples, which a PromptCache encodes once, and each ends with
+    an extract of prompt_len tokens cut from a corpus text.
+    """
+    level, text_type, gen_type = BENCH_CONFIGURATION
+    # the prompt around a placeholder for the extract
+    before, after = get_prompt(gen_type, text_type, level, "\0").split("\0")
+    prompts = {}
+    items = itertools.cycle(texts.items())
+    for i, (text_id, text) in enumerate(itertools.islice(items, batch_size)):
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        # short texts are repeated up to the prompt length
+        ids = (ids * (prompt_len // len(ids) + 1))[:prompt_len]
+        prompts[f"{text_id}_{i}"] = before + tokenizer.decode(ids) + after
+    return prompts
+
+
+def run_generation_case(
+    model_dir,
+    prompt_len,
+    max_new_tokens,
+    top_k,
+    batch_size,
+    capture,
+    repeats=3,
+    output_format="jsonl",
+    warmup=1,
+):
+    """Time the generation of a batch, after warmup untimed runs.
+
+    Batches go through generate_with_logprobs with a PromptCache, retries
+    included, and their samples are written by save_results under
+    benchmarks/results/, as in generate.py, with the same seed for each
+    repeat of each case. Meant to run in a process of its own, which loads
+    the model, so that its peak RSS is that of the case alone. Returns the
+    medians of the timed runs.
+    """
+    generate.RESULTS_DIR = BENCH_RESULTS_DIR
+    model, tokenizer = load_model(model_dir, "cpu")
+    load_rss = get_peak_rss()
+    texts = get_corpus_texts()
+    prompts = get_bench_prompts(tokenizer, texts, prompt_len, batch_size)
+
+    # as in generate.py, the prefix is the one shared by all the prompts of
+    # the configuration, whatever the batch size, not by those of the batch
+    start = time.perf_counter()
+    prompt_cache = PromptCache(
+        model, tokenizer, get_bench_prompts(tokenizer, texts, prompt_len, len(texts))
+    )
+    prefix_cache_s = time.perf_counter() - start
+
+    runs = []
+    for repeat in range(warmup + repeats):
+        torch.manual_seed(repeat)
+        telemetry = Telemetry("cpu")
+        generations = generate_with_logprobs(
+            "cpu",
+            model,
+            tokenizer,
+            prompts,
+            top_k=top_k,
+            max_new_tokens=max_new_tokens,
+            capture=capture,
+            prompt_cache=prompt_cache,
+            telemetry=telemetry,
+            stop_strings=PROMPT_DELIMITERS,
+        )
+        for sample_id, (records, text) in generations.items():
+            save_results(
+                get_model_name(model_dir),
+                *BENCH_CONFIGURATION,
+                sample_id,
+                records,
+                text,
+                output_format,
+                telemetry=telemetry,
+            )
+        metrics = telemetry.get_metrics()
+        if repeat < warmup:
+            continue
+        tokens = sum(len(records) for records, _ in generations.values())
+        runs.append(
+            {
+                "latency_s": metrics["seconds"],
+                "tokens": tokens,
+                "tokens_per_s": tokens / metrics["seconds"],
+                "retries": metrics["retries"],
+                "rejected": metrics["rejected"],
+                **{f"{k}_s": v for k, v in metrics["phases"].items()},
+            }
+        )
+
+    return {
+        "prompt_len": prompt_len,
+        "max_new_tokens": max_new_tokens,
+        "top_k": top_k,
+        "batch_size": batch_size,
+        "capture": capture,
+        "prompt_tokens": sum(telemetry.prompt_tokens.values()),
+        "cached_tokens": len(prompt_cache.prefix_ids),
+        "prefix_cache_s": prefix_cache_s,
+        **{k: statistics.median(run.get(k, 0.0) for run in runs) for k in runs[0]},
+        "load_rss_mib": load_rss,
+        "peak_rss_mib": get_peak_rss(),
+    }
+
+
+def benchmark_generation(
+    prompt_lens,
+    max_new_tokens,
+    top_ks,
+    batch_sizes,
+    captures,
+    repeats=3,
+    output_format="jsonl",
+    model_dir=MODEL_DIR,
+    rebuild=False,
+):
+    """Time every combination of the parameters with a tiny random model.
+
+    The model is built once in model_dir, and loaded again by later runs so
+    that they compare the same weights. Each case runs in a new process, so
+    that its peak RSS does not carry over the peaks of the previous cases.
+    Returns the cases as a DataFrame.
+    """
+    if rebuild or not os.path.exists(os.path.join(model_dir, "config.json")):
+        build_tiny_model(model_dir)
+
+    cases = []
+    for case in itertools.product(
+        prompt_lens, max_new_tokens, top_ks, batch_sizes, captures
+    ):
+        print(f"Running {dict(zip(GENERATION_CASE, case))}")
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            cases.append(
+                executor.submit(
+                    run_generation_case, model_dir, *case, repeats, output_format
+                ).result()
+            )
+
+    return pd.DataFrame(cases)
+
+
+def write_synthetic_tree(root, models, files, steps, top_k, vocab_size=5000, seed=0):
+    """Write synthetic logits files in the layout of the results folder.
+
+    Each model gets files logits files of steps steps, dealt between the
+    configurations, with their generated texts. Tokens follow a Zipf law
+    over vocab_size words, the pair tokens being among the most frequent,
+    and each step records a top-k of distinct tokens with decreasing
+    logprobs, the chosen token being drawn from them.
+    """
+    rng = np.random.default_rng(seed)
+    words = [word for pair in SYNTHETIC_PAIRS for word in (*pair, *pair.values())]
+    words += [f"mot{i}" for i in range(vocab_size - len(words))]
+    vocab = np.array(["Ġ" + word for word in words], dtype=object)
+    # Gumbel noise over these log weights draws k tokens without replacement
+    log_weights = -np.log(np.arange(1, len(vocab) + 1))
+    configurations = [
+        (lvl, txt, gen) for lvl in LEVELS for txt in TEXT_TYPES for gen in GEN_TYPES
+    ]
+
+    for model in models:
+        for i in range(files):
+            lvl, txt, gen = configurations[i % len(configurations)]
+            logits_path, gen_path = get_output_paths(
+                model, lvl, txt, gen, f"{i:05d}_synth"
+            )
+            logits_path = os.path.join(root, os.path.relpath(logits_path, "results"))
+            gen_path = os.path.join(root, os.path.relpath(gen_path, "results"))
+
+            noise = rng.gumbel(size=(steps, len(vocab)))
+            top_ids = np.argpartition(-(log_weights + noise), top_k, axis=1)[:, :top_k]
+            logprobs = -np.cumsum(rng.exponential(0.5, size=(steps, top_k)), axis=1)
+            probs = np.exp(logprobs - logprobs.max(axis=1, keepdims=True))
+            cumprobs = np.cumsum(probs / probs.sum(axis=1, keepdims=True), axis=1)
+            ranks = (cumprobs < rng.random((steps, 1))).sum(axis=1)
+            ranks = np.minimum(ranks, top_k - 1)
+
+            tokens = vocab[top_ids]
+            chosen = tokens[np.arange(steps), ranks]
+            pieces = [token.replace("Ġ", " ") for token in chosen]
+            offsets = np.cumsum([0] + [len(piece) for piece in pieces[:-1]])
+
+            os.makedirs(os.path.dirname(logits_path), exist_ok=True)
+            os.makedirs(os.path.dirname(gen_path), exist_ok=True)
+            with open(logits_path, "w", encoding="utf-8") as f:
+                for step in range(steps):
+                    record = {
+                        "step": step,
+                        "token": chosen[step],
+                        "logprob": float(logprobs[step, ranks[step]]),
+                        "rank": int(ranks[step]),
+                        "top_k": [
+                            {"token": token, "logprob": float(logprob)}
+                            for token, logprob in zip(tokens[step], logprobs[step])
+                        ],
+                        "offset": int(offsets[step]),
+                    }
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            with open(gen_path, "w", encoding="utf-8") as f:
+                f.write("".join(pieces))
+
+
+def get_synthetic_tree(models, files, steps, top_k, rebuild=False):
+    """Return the root of a synthetic tree, written unless already there."""
+    root = os.path.join(SYNTHETIC_DIR, f"f{files}_s{steps}_k{top_k}")
+    done = os.path.join(root, ".complete")
+    if rebuild or not os.path.exists(done):
+        print(f"Writing {files} synthetic files of {steps} steps per model...")
+        write_synthetic_tree(root, models, files, steps, top_k)
+        # marks a tree fully written, so that an interrupted one is redone
+        with open(done, "w", encoding="utf-8") as f:
+            f.write(json.dumps(models))
+    return root
+
+
+def run_analysis(root, models, token_pairs, min_ratio, workers=None, trace=False):
+    """Run the stages of plot.py on a tree and measure each one.
+
+    Returns, by stage, its seconds summed over the models, or with trace,
+    its peak of memory allocated in MiB (tracemalloc only sees the main
+    process, not the processes parsing the files).
+    """
+    measures = dict.fromkeys(ANALYSIS_STAGES, 0.0)
+
+    def measure(stage, func, *args, **kwargs):
+        if trace:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+        else:
+            start = time.perf_counter()
+        result = func(*args, **kwargs)
+        if trace:
+            peak = (tracemalloc.get_traced_memory()[1] - start) / 2**20
+            measures[stage] = max(measures[stage], peak)
+        else:
+            measures[stage] += time.perf_counter() - start
+        return result
+
+    if trace:
+        tracemalloc.start()
+    points = []
+    for model in models:
+        folder = os.path.join(root, get_model_name(model), "*/*/*_task/logits/*")
+        logs = measure("load_log_files", load_log_files, folder, True, workers)
+        df = measure("extract_pair_data", extract_pair_data, logs, token_pairs)
+        del logs
+        df = measure("calculate_confidence_metrics", calculate_confidence_metrics, df)
+        points.append(
+            measure("select_ratio_points", select_ratio_points, df, min_ratio)
+        )
+        del df
+
+    # the figures are built but neither shown nor saved
+    renderer = pio.renderers.default
+    pio.renderers.default = ""
+    try:
+        names = {v: k for k, v in ANALYSIS_MODELS.items()}
+        plot_models = [names[model] for model in models]
+        measure(
+            "plot_pair_probabilities",
+            plot_pair_probabilities,
+            points,
+            min_ratio,
+            plot_models,
+        )
+        measure("plot_surprisal_context", plot_surprisal_context, points, plot_models)
+    finally:
+        pio.renderers.default = renderer
+        if trace:
+            tracemalloc.stop()
+
+    return measures
+
+
+def benchmark_analysis(
+    files,
+    steps,
+    top_k,
+    models,
+    min_ratio=1 / 3,
+    workers=None,
+    repeats=3,
+    memory=True,
+    rebuild=False,
+):
+    """Time each stage of plot.py on synthetic trees of growing sizes.
+
+    There is a tree for every combination of files (per model), steps and
+    top_k. Each stage is timed repeats times after an untimed run, the
+    median being kept, and its peak memory is measured in a separate run, as tracing allocations
+    slows the stages down. Returns a row per tree and stage.
+    """
+    cases = []
+    for num_files, num_steps, k in itertools.product(files, steps, top_k):
+        root = get_synthetic_tree(models, num_files, num_steps, k, rebuild)
+        # the first run is not timed, as it warms up plotly
+        runs = [
+            run_analysis(root, models, SYNTHETIC_PAIRS[:1], min_ratio, workers)
+            for _ in range(repeats + 1)
+        ][1:]
+        peaks = {}
+        if memory:
+            peaks = run_analysis(
+                root, models, SYNTHETIC_PAIRS[:1], min_ratio, workers, trace=True
+            )
+        for stage in ANALYSIS_STAGES:
+            cases.append(
+                {
+                    "files": num_files,
+                    "steps": num_steps,
+                    "top_k": k,
+                    "stage": stage,
+                    "total_steps": num_files * num_steps * len(models),
+                    "seconds": statistics.median(run[stage] for run in runs),
+                    "peak_mib": peaks.get(stage),
+                }
+            )
+        print(f"Timed {num_files} files of {num_steps} steps per model, top-{k}")
+
+    return pd.DataFrame(cases)
+
+
+def get_scaling(cases):
+    """Return the exponent of the growth of the time of each stage with data size.
+
+    An exponent of 1 is a time proportional to the number of steps. It is
+    the slope of log time against log steps, over the trees of every size.
+    """
+    exponents = {}
+    for stage, group in cases.groupby("stage", sort=False):
+        if group["total_steps"].nunique() < 2:
+            continue
+        exponents[stage] = np.polyfit(
+            np.log(group["total_steps"]), np.log(group["seconds"]), 1
+        )[0]
+    return pd.Series(exponents, name="exponent")
+
+
+def save_benchmark(path, name, cases, **config):
+    """Save the cases of a benchmark with the environment they ran in."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "benchmark": name,
+                "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "torch": torch.__version__,
+                "transformers": transformers.__version__,
+                "threads": torch.get_num_threads(),
+                "cpus": os.cpu_count(),
+                "config": config,
+                "cases": cases.to_dict(orient="records"),
+            },
+            f,
+            indent=2,
+        )
+    print(f"Benchmark saved to {path}")
+
+
+def compare_benchmark(cases, baseline_path, keys, metric):
+    """Add the ratio of metric to its value in a saved run, for the same cases."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = pd.DataFrame(json.load(f)["cases"])
+
+    baseline = baseline[keys + [metric]].rename(columns={metric: "baseline"})
+    cases = cases.merge(baseline, on=keys, how="left")
+    cases[f"{metric}_ratio"] = cases[metric] / cases.pop("baseline")
+    return cases
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline offline, on a plain CPU"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    generation = subparsers.add_parser(
+        "generate",
+        help="Time generate.py with a tiny randomly initialized model",
+    )
+    generation.add_argument(
+        "--prompt_lens",
+        type=int,
+        nargs="+",
+        default=[64, 512, 2048],
+        help="Lengths in tokens of the extract ending each prompt, after the few-shot prefix shared by the prompts (default: 64 512 2048)",
+    )
+    generation.add_argument(
+        "-tk",
+        "--max_new_tokens",
+        type=int,
+        nargs="+",
+        default=[32, 128],
+        help="Maximum numbers of new tokens (default: 32 128)",
+    )
+    generation.add_argument(
+        "-k",
+        "--top_k",
+        type=int,
+        nargs="+",
+        default=[30],
+        help="Numbers of top-k alternatives recorded (default: 30)",
+    )
+    generation.add_argument(
+        "-b",
+        "--batch_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Numbers of prompts generated together (default: 1 4)",
+    )
+    generation.add_argument(
+        "-c",
+        "--capture",
+        type=str,
+        nargs="+",
+        choices=["stream", "scores"],
+        default=["stream"],
+        help="Capture modes of the step logprobs (default: 'stream')",
+    )
+    generation.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Timed runs of each case, after an untimed one (default: 3)",
+    )
+    generation.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=["jsonl", "parquet"],
+        default="jsonl",
+        help="Format of the logits files written (default: 'jsonl')",
+    )
+    generation.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build the tiny model again instead of reusing the saved one",
+    )
+
+    analysis = subparsers.add_parser(
+        "analysis",
+        help="Time the stages of plot.py on synthetic logits files of growing size",
+    )
+    analysis.add_argument(
+        "--files",
+        type=int,
+        nargs="+",
+        default=[8, 32, 128],
+        help="Numbers of logits files per model (default: 8 32 128)",
+    )
+    analysis.add_argument(
+        "--steps",
+        type=int,
+        nargs="+",
+        default=[512],
+        help="Numbers of steps per file (default: 512)",
+    )
+    analysis.add_argument(
+        "-k",
+        "--top_k",
+        type=int,
+        nargs="+",
+        default=[30],
+        help="Numbers of top-k alternatives per step (default: 30)",
+    )
+    analysis.add_argument(
+        "-m",
+        "--models",
+        type=str,
+        nargs="+",
+        choices=list(ANALYSIS_MODELS),
+        default=list(ANALYSIS_MODELS),
+        help="Models of the synthetic trees (default: llama mistral qwen)",
+    )
+    analysis.add_argument(
+        "-p",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the logits files in parallel (default: one per core)",
+    )
+    analysis.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Timed runs of each tree (default: 3)",
+    )
+    analysis.add_argument(
+        "--no_memory",
+        action="store_true",
+        help="Skip the run measuring the peak memory of each stage",
+    )
+    analysis.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Write the synthetic trees again instead of reusing the saved ones",
+    )
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument(
+            "-o",
+            "--output",
+            type=str,
+            default=None,
+            help=f"JSON file of the results (default: '{BENCH_DIR}/<benchmark>_<date>.json')",
+        )
+        subparser.add_argument(
+            "--baseline",
+            type=str,
+            default=None,
+            help="JSON file of a previous run, whose results are compared with these",
+        )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "generate":
+        config = {
+            "prompt_lens": args.prompt_lens,
+            "max_new_tokens": args.max_new_tokens,
+            "top_k": args.top_k,
+            "batch_sizes": args.batch_sizes,
+            "capture": args.capture,
+            "repeats": args.repeats,
+            "output_format": args.format,
+        }
+        cases = benchmark_generation(
+            args.prompt_lens,
+            args.max_new_tokens,
+            args.top_k,
+            args.batch_sizes,
+            args.capture,
+            args.repeats,
+            args.format,
+            rebuild=args.rebuild,
+        )
+        keys, metric = GENERATION_CASE, "tokens_per_s"
+    else:
+        config = {
+            "files": args.files,
+            "steps": args.steps,
+            "top_k": args.top_k,
+            "models": args.models,
+            "workers": args.workers,
+            "repeats": args.repeats,
+        }
+        cases = benchmark_analysis(
+            args.files,
+            args.steps,
+            args.top_k,
+            [ANALYSIS_MODELS[model] for model in args.models],
+            workers=args.workers,
+            repeats=args.repeats,
+            memory=not args.no_memory,
+            rebuild=args.rebuild,
+        )
+        keys, metric = ANALYSIS_CASE, "seconds"
+
+    output = args.output or os.path.join(
+        BENCH_DIR,
+        f"{args.benchmark}_{datetime.datetime.now():%Y%m%d-%H%M%S}.json",
+    )
+    save_benchmark(output, args.benchmark, cases, **config)
+    if args.baseline is not None:
+        cases = compare_benchmark(cases, args.baseline, keys, metric)
+
+    print(cases.to_string(index=False, float_format="{:.3f}".format))
+    if args.benchmark == "analysis":
+        print(get_scaling(cases).to_string(float_format="{:.2f}".format))
@@ -2,10 +2,158 @@ import json
 import os
 import re
 
+import pandas as pd
+from atomic import atomic_open
 from sentence_splitter import split_text_into_sentences
 
-
-def load_corpus(level, corpus_type, extract=False):
+DATA_DIR = "data"
+SENTENCES_CACHE = os.path.join(DATA_DIR, ".sentences.json")
+# delimiters of the few-shot examples in get_prompt, which end generation
+PROMPT_DELIMITERS = ["<example>", "</example>", "___"]
+
+# CE1 files are named <num>_<lit|litt|sci>_<orig|simp>_<title>, CM1 files
+# <num>_<LEVEL>_<lit|sci>_<Title>_<ORIG|SIMP>.txt, sometimes with a stray
+# space after the number
+FILENAME_PATTERNS = [
+    re.compile(
+        r"^(?P<num>\d+)_\s*(?P<kind>litt?|sci)_(?P<version>orig|simp)_(?P<title>.+?)(\.txt)?$",  # noqa: E501
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"^(?P<num>\d+)_\s*\w+?_(?P<kind>litt?|sci)_(?P<title>.+?)_(?P<version>orig|simp)(\.txt)?$",  # noqa: E501
+        re.IGNORECASE,
+    ),
+]
+CATALOG_COLUMNS = ["text_id", "level", "num", "text_type", "title", "version", "path"]
+
+# catalogs already built, by data directory, with the mtimes of its levels
+_catalogs = {}
+# texts already read, by path, with their mtime
+_texts = {}
+# sentence splits of the texts, by path, with the mtime of the split text
+_sentences = None
+
+
+def parse_filename(filename):
+    """Return the num, text type, title and version of a corpus filename.
+
+    Returns None for a filename that is not a corpus text.
+    """
+    for pattern in FILENAME_PATTERNS:
+        match = pattern.match(filename)
+        if match:
+            return {
+                "num": int(match["num"]),
+                "text_type": (
+                    "scientific" if match["kind"].lower() == "sci" else "literature"
+                ),
+                "title": match["title"],
+                "version": match["version"].lower(),
+            }
+
+    return None
+
+
+def get_catalog(data_dir=DATA_DIR):
+    """Return a DataFrame with one row per text of the corpus.
+
+    Each text is identified by its filename (text_id) and described by its
+    level, num, text_type, title and version ("orig" or "simp"). Filenames
+    are only parsed again when a level folder changes.
+    """
+    levels = sorted(
+        d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d))
+    )
+    mtimes = {
+        level: os.stat(os.path.join(data_dir, level)).st_mtime_ns for level in levels
+    }
+    if data_dir in _catalogs and _catalogs[data_dir][0] == mtimes:
+        return _catalogs[data_dir][1]
+
+    rows = []
+    for level in levels:
+        for filename in sorted(os.listdir(os.path.join(data_dir, level))):
+            fields = parse_filename(filename)
+            if fields is None:
+                continue
+            rows.append(
+                {
+                    "text_id": filename,
+                    "level": level,
+                    **fields,
+                    "path": os.path.join(data_dir, level, filename),
+                }
+            )
+
+    catalog = pd.DataFrame(rows, columns=CATALOG_COLUMNS)
+    _catalogs[data_dir] = (mtimes, catalog)
+
+    return catalog
+
+
+def select_texts(data_dir=DATA_DIR, **fields):
+    """Return the catalog rows matching every given field.
+
+    Each field takes a value or a list of values, for example
+    select_texts(level="cm1", text_type="literature", version=["orig"]).
+    """
+    catalog = get_catalog(data_dir)
+
+    mask = pd.Series(True, index=catalog.index)
+    for name, value in fields.items():
+        if name not in catalog.columns:
+            raise ValueError(f"field must be one of {CATALOG_COLUMNS}, got {name}")
+        values = [value] if isinstance(value, (str, int)) else list(value)
+        mask &= catalog[name].isin(values)
+
+    return catalog[mask]
+
+
+def read_text(path):
+    """Return the content of a corpus text, read again only once modified."""
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _texts or _texts[path][0] != mtime:
+        with open(path, "r") as f:
+            _texts[path] = (mtime, f.read())
+
+    return _texts[path][1]
+
+
+def get_sentences(path):
+    """Return the sentences of a corpus text.
+
+    Splits are cached on disk and only computed again when the text is
+    modified.
+    """
+    global _sentences
+    if _sentences is None:
+        _sentences = {}
+        if os.path.exists(SENTENCES_CACHE):
+            with open(SENTENCES_CACHE, encoding="utf-8") as f:
+                _sentences = json.load(f)
+
+    mtime = os.stat(path).st_mtime_ns
+    entry = _sentences.get(path)
+    if entry is None or entry["mtime"] != mtime:
+        entry = {
+            "mtime": mtime,
+            "sentences": split_text_into_sentences(read_text(path), language="fr"),
+        }
+        _sentences[path] = entry
+
+        os.makedirs(os.path.dirname(SENTENCES_CACHE), exist_ok=True)
+        with atomic_open(SENTENCES_CACHE) as f:
+            json.dump(_sentences, f, ensure_ascii=False)
+
+    return entry["sentences"]
+
+
+def load_corpus(level, corpus_type, extract=False, split=False):
+    """Return the texts of a level and type, by text id.
+
+    With extract, each text is reduced to its first two sentences; with
+    split, each text is the (extract, rest) pair of split_extract.
+    """
     if level not in ["ce1", "cm1"]:
         raise ValueError(f"level must be one of ['ce1', 'cm1'], got {level}")
 
@@ -14,24 +162,27 @@ def load_corpus(level, corpus_type, extract=False):
             f"corpus_type must be one of ['literature', 'scientific'], got {corpus_type}"
         )
 
-    corpus_path = f"data/{level}/"
     corpus_data = {}
 
-    pattern = r"^\d+_(\w+_)?lit" if corpus_type == "literature" else r"^\d+_(\w+_)?sci"
-
-    for fl in os.listdir(corpus_path):
-        if re.match(pattern, fl):
-            with open(os.path.join(corpus_path, fl), "r") as f:
-                if extract:
-                    corpus_data[fl] = " ".join(
-                        split_text_into_sentences(f.read(), language="fr")[0:2]
-                    )
-                else:
-                    corpus_data[fl] = f.read()
+    for text_id, path in select_texts(level=level, text_type=corpus_type)[
+        ["text_id", "path"]
+    ].itertuples(index=False):
+        if split:
+            corpus_data[text_id] = split_extract(path)
+        elif extract:
+            corpus_data[text_id] = split_extract(path)[0]
+        else:
+            corpus_data[text_id] = read_text(path)
 
     return corpus_data
 
 
+def split_extract(path):
+    """Split a corpus text into its extract (first two sentences) and the rest."""
+    sentences = get_sentences(path)
+    return " ".join(sentences[0:2]), " ".join(sentences[2:])
+
+
 def get_all_extracts():
     extracts = {
         "ce1_lit": get_extracts("ce1", "literature"),
@@ -1,119 +1,1247 @@
 import argparse
+import bisect
+import contextlib
+import copy
+import datetime
+import functools
+import gc
+import hashlib
 import json
+import multiprocessing
 import os
+import re
+import resource
+import threading
+import time
+from queue import Empty
 
 import torch
-from corpus import get_prompt, load_corpus
+from atomic import atomic_open
+from corpus import PROMPT_DELIMITERS, get_prompt, load_corpus, select_texts
+from store import read_logits, write_logits
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    MinPLogitsWarper,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
 
+RESULTS_DIR = "results"
+LEVELS = ["ce1", "cm1"]
+TEXT_TYPES = ["literature", "scientific"]
+GEN_TYPES = ["continuation", "generation"]
+TEMPERATURE = 1.0
+TOP_P = 0.9
+PRECISIONS = ["float32", "bfloat16", "int8"]
+# approximate memory held by a token of a record, or by one of its top-k or
+# watched entries, in bytes
+ENTRY_BYTES = 250
 
-def load_model(model, device):
-    """Load the model and tokenizer."""
+
+def load_model(model, device, precision=None):
+    """Load the model and tokenizer.
+
+    By default, weights are loaded in float16 on GPU and in float32 on CPU.
+    precision overrides this with "float32", "bfloat16", or "int8" for
+    float32 weights whose linear layers are dynamically quantized to int8
+    (CPU only).
+    """
     print("Loading tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(model)
+    # left padding keeps every prompt flush against its first generated token
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
     print("Loading model...")
+    if precision is None:
+        dtype = torch.float16 if device != "cpu" else torch.float32
+    elif precision == "bfloat16":
+        dtype = torch.bfloat16
+    else:
+        dtype = torch.float32
     model = AutoModelForCausalLM.from_pretrained(
         model,
-        torch_dtype=torch.float16 if device != "cpu" else torch.float32,
+        torch_dtype=dtype,
         device_map="auto",
     )
 
+    if precision == "int8":
+        # weights are stored in int8 and activations quantized on the fly
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
     return model, tokenizer
 
 
-def generate_with_logprobs(
-    device, model, tokenizer, prompt_id, prompt, top_k=30, max_new_tokens=512
+def get_results_id(model_id, precision=None):
+    """Return the id under which the results of a model are saved.
+
+    Results of an explicit precision are kept apart from those of the
+    default precision, which serve as the baseline to validate them.
+    """
+    if precision is None:
+        return model_id
+    return f"{model_id.rstrip('/')}_{precision}"
+
+
+def get_peak_rss(children=False):
+    """Return the peak resident set size in MiB of the process.
+
+    With children, return the largest peak of its terminated child processes.
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def get_peak_device_memory(device):
+    """Return the peak memory in MiB allocated on the GPU since its last reset."""
+    if device == "cpu":
+        return None
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
+class Telemetry:
+    """Phase timings and counters of the generation of a batch.
+
+    Phases are timed in wall time. On GPU, the device is synchronized around
+    each phase, so that the kernels it queued are not charged to the next.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.start = time.perf_counter()
+        self.phases = {}
+        # prompt tokens by prompt id, and the prompt id of each sample
+        self.prompt_tokens = {}
+        self.samples = {}
+        self.retries = 0
+        self.rejected = 0
+        # sequences ended by a stop string
+        self.stopped = 0
+        # samples missing for the prompts given up on, by prompt id
+        self.dropped = {}
+        if device != "cpu":
+            torch.cuda.reset_peak_memory_stats()
+
+    def sync(self):
+        if self.device != "cpu":
+            torch.cuda.synchronize()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        self.sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sync()
+            self.add(phase, time.perf_counter() - start)
+
+    def get_metrics(self):
+        """Return the metrics of the batch as a picklable dict."""
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "phases": dict(self.phases),
+            "prompt_tokens": dict(self.prompt_tokens),
+            "samples": dict(self.samples),
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "stopped": self.stopped,
+            "dropped": dict(self.dropped),
+            # the peak of the whole process so far, not that of the batch
+            "process_peak_rss_mib": get_peak_rss(),
+            "peak_device_mib": get_peak_device_memory(self.device),
+        }
+
+
+def get_model_name(model_id):
+    """Return the name used for the results folder of a model."""
+    return os.path.basename(model_id.rstrip("/"))
+
+
+def get_task_name(gen_type, score_source=None):
+    """Return the folder name of a generation task, or of a scoring task."""
+    if score_source is None:
+        return f"{gen_type}_task"
+    return f"{gen_type}_score_{get_model_name(score_source)}"
+
+
+def get_output_paths(
+    model_id,
+    level,
+    text_type,
+    gen_type,
+    prompt_id,
+    output_format="jsonl",
+    score_source=None,
+):
+    """Return the (logits, generated text) paths for a prompt."""
+    model_name = get_model_name(model_id)
+    task_dir = os.path.join(
+        RESULTS_DIR,
+        model_name,
+        level,
+        text_type,
+        get_task_name(gen_type, score_source),
+    )
+    file_id = f"{model_name}_{prompt_id}_{text_type}_{gen_type}"
+
+    return (
+        os.path.join(task_dir, "logits", f"token_logits_{file_id}.{output_format}"),
+        os.path.join(task_dir, "gen", f"generated_text_{file_id}.txt"),
+    )
+
+
+def get_manifest_path(
+    model_id, level, text_type, gen_type, top_k, max_new_tokens, score_source=None
+):
+    """Return the manifest path of a run configuration."""
+    return os.path.join(
+        RESULTS_DIR,
+        get_model_name(model_id),
+        level,
+        text_type,
+        get_task_name(gen_type, score_source),
+        (
+            f"manifest_k{top_k}_n{max_new_tokens}.json"
+            if score_source is None
+            else f"manifest_k{top_k}.json"
+        ),
+    )
+
+
+def get_metrics_path(manifest_path):
+    """Return the metrics file of a run configuration, next to its manifest."""
+    manifest_dir, filename = os.path.split(manifest_path)
+    filename = filename.replace("manifest_", "metrics_", 1)
+    return os.path.join(manifest_dir, os.path.splitext(filename)[0] + ".jsonl")
+
+
+def add_metrics(totals, metrics):
+    """Add the totals of a batch, as returned by save_batch, to run totals."""
+    for key, value in metrics.items():
+        if key in ("phases", "write_phases"):
+            phases = totals.setdefault(key, {})
+            for phase, seconds in value.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        elif key == "peak_device_mib":
+            if value is not None:
+                totals[key] = max(totals.get(key) or 0.0, value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+    return totals
+
+
+def print_summary(totals, seconds, peak_rss):
+    """Print the end-of-run summary of the totals of add_metrics.
+
+    Compute phases are given as shares of their total. Results are written
+    in the background while the next batches are generated, so the write
+    phases are given apart, in seconds only.
+    """
+    tokens = totals.get("generated_tokens", 0)
+    print(
+        f"Saved {totals.get('samples', 0)} samples, {tokens} tokens "
+        f"({totals.get('prompt_tokens', 0)} prompt tokens) in {seconds:.1f}s "
+        f"({tokens / seconds:.1f} tokens/s), {totals.get('retries', 0)} retries, "
+        f"{totals.get('rejected', 0)} rejected sequences, "
+        f"{totals.get('stopped', 0)} sequences ended by a stop string, "
+        f"{totals.get('dropped', 0)} prompts dropped"
+    )
+    phases = totals.get("phases", {})
+    if phases:
+        compute = sum(phases.values())
+        print(
+            "Compute time per phase: "
+            + ", ".join(
+                f"{phase} {phase_seconds:.1f}s ({phase_seconds / compute:.0%})"
+                for phase, phase_seconds in phases.items()
+            )
+        )
+    write_phases = totals.get("write_phases", {})
+    if write_phases:
+        print(
+            "Background writes: "
+            + ", ".join(
+                f"{phase} {phase_seconds:.1f}s"
+                for phase, phase_seconds in write_phases.items()
+            )
+        )
+    peak = f"Process peak RSS {peak_rss:.0f} MiB"
+    if totals.get("peak_device_mib") is not None:
+        peak += f", peak GPU memory {totals['peak_device_mib']:.0f} MiB"
+    print(peak)
+
+
+def load_manifest(path, config):
+    """Load the manifest of a run, or start a new one for config.
+
+    A manifest written with another config (watched tokens, stop strings...)
+    does not describe the files this run would write, so a new one is
+    started instead. With config None, the manifest is loaded as is.
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if config is None:
+            return manifest
+
+        # compare as saved, with tuples turned into lists; keys added since
+        # the manifest was written are unset in it
+        config = json.loads(json.dumps(config))
+        saved = manifest.get("config") or {}
+        changed = sorted(
+            key for key in set(config) | set(saved) if config.get(key) != saved.get(key)
+        )
+        if not changed:
+            manifest["config"] = config
+            return manifest
+
+        print(
+            f"{path} was written with another config ({', '.join(changed)}), "
+            "starting a new manifest"
+        )
+
+    return {"config": config, "completed": {}}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_open(path) as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+
+def get_file_hash(path):
+    """Return the SHA-256 hex digest of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_completed(manifest, manifest_path, prompt_id):
+    """Check that a prompt is done and that its files are still as written."""
+    entry = manifest["completed"].get(prompt_id)
+    if entry is None:
+        return False
+
+    manifest_dir = os.path.dirname(manifest_path)
+    for rel_path, file_hash in entry["files"].items():
+        path = os.path.join(manifest_dir, rel_path)
+        if not os.path.exists(path) or get_file_hash(path) != file_hash:
+            return False
+
+    return True
+
+
+def get_batches(tokenizer, prompts, batch_size=1):
+    """Split prompts into batches of prompts with similar token lengths.
+
+    Prompts are sorted by token length before being chunked, so that each
+    batch needs as little left padding as possible.
+    """
+    lengths = {k: len(tokenizer(v)["input_ids"]) for k, v in prompts.items()}
+    ordered = sorted(prompts, key=lambda k: lengths[k])
+
+    return [
+        {k: prompts[k] for k in ordered[i : i + batch_size]}
+        for i in range(0, len(ordered), batch_size)
+    ]
+
+
+def pad_token_ids(input_ids, pad_token_id, device, prefix_len=0):
+    """Left-pad token id lists into a batch.
+
+    The padding goes after the first prefix_len tokens, which all lists
+    share, so that a cache of these tokens stays valid for every row.
+    """
+    max_len = max(len(ids) for ids in input_ids)
+    padded_ids = [
+        ids[:prefix_len] + [pad_token_id] * (max_len - len(ids)) + ids[prefix_len:]
+        for ids in input_ids
+    ]
+    attention_mask = [
+        [1] * prefix_len + [0] * (max_len - len(ids)) + [1] * (len(ids) - prefix_len)
+        for ids in input_ids
+    ]
+
+    return {
+        "input_ids": torch.tensor(padded_ids, device=device),
+        "attention_mask": torch.tensor(attention_mask, device=device),
+    }
+
+
+def get_position_ids(attention_mask):
+    """Return the position of each token of a left-padded batch."""
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids
+
+
+class PromptCache:
+    """KV cache of the tokens shared by the beginning of a set of prompts.
+
+    All prompts of a configuration start with the same instruction and
+    few-shot examples; this prefix is run through the model once, and its
+    cache is reused by every batch generated from these prompts.
+    """
+
+    def __init__(self, model, tokenizer, prompts):
+        input_ids = [tokenizer(prompt)["input_ids"] for prompt in prompts.values()]
+
+        prefix_len = 0
+        for tokens in zip(*input_ids):
+            if any(token != tokens[0] for token in tokens):
+                break
+            prefix_len += 1
+        # generate needs at least one token of each prompt that is not cached
+        prefix_len = min(prefix_len, min(len(ids) for ids in input_ids) - 1)
+
+        self.prefix_ids = input_ids[0][:prefix_len]
+        self.pad_token_id = tokenizer.pad_token_id
+
+        with torch.no_grad():
+            self.cache = model(
+                torch.tensor([self.prefix_ids], device=model.device),
+                past_key_values=DynamicCache(),
+                use_cache=True,
+            ).past_key_values
+
+    def get_inputs(self, tokenizer, prompts, device):
+        """Tokenize prompts, padding them between the prefix and their end."""
+        return self.pad_inputs(
+            [tokenizer(prompt)["input_ids"] for prompt in prompts], device
+        )
+
+    def pad_inputs(self, input_ids, device):
+        """Pad token id lists between the prefix and their end."""
+        for ids in input_ids:
+            if ids[: len(self.prefix_ids)] != self.prefix_ids:
+                raise ValueError("Prompt does not start with the cached prefix")
+
+        return pad_token_ids(input_ids, self.pad_token_id, device, len(self.prefix_ids))
+
+    def get_cache(self, batch_size):
+        """Return a copy of the prefix cache for a batch, as generate extends it."""
+        cache = copy.deepcopy(self.cache)
+        cache.batch_repeat_interleave(batch_size)
+        return cache
+
+
+def get_eos_ids(model, tokenizer):
+    """Return the set of token ids that end a generated sequence."""
+    eos_ids = model.generation_config.eos_token_id
+    if eos_ids is None:
+        eos_ids = tokenizer.eos_token_id
+    if isinstance(eos_ids, int):
+        eos_ids = [eos_ids]
+
+    return set(eos_ids)
+
+
+def get_sequence_length(generated_ids, eos_ids):
+    """Return the number of generated tokens up to and including the first EOS.
+
+    In a batch, sequences that finish early are padded until the longest one
+    is done; those padding steps are not part of the sequence.
+    """
+    for i, token_id in enumerate(generated_ids.tolist()):
+        if token_id in eos_ids:
+            return i + 1
+
+    return len(generated_ids)
+
+
+def get_stop_length(text, offsets, stop_strings):
+    """Return the number of tokens of a sequence before its first stop string.
+
+    offsets are those of decode_incremental. A token in which the stop
+    string starts is dropped with it. Returns None if no stop string is in
+    the text.
+    """
+    positions = [text.find(stop) for stop in stop_strings]
+    positions = [position for position in positions if position >= 0]
+    if not positions:
+        return None
+
+    # the text of token i ends where token i + 1 starts
+    ends = offsets[1:] + [len(text)]
+    return bisect.bisect_right(ends, min(positions))
+
+
+def decode_incremental(tokenizer, token_ids):
+    """Decode a generated sequence token by token.
+
+    Returns the decoded text and, for each token, the offset in that text at
+    which the token starts: the context preceding step i is text[:offsets[i]].
+    As in streaming detokenizers, each step only decodes a small window of
+    tokens rather than the whole prefix, and a token ending with an
+    incomplete character is held back until the following tokens complete it.
+    """
+    text = ""
+    offsets = []
+    prefix_offset = read_offset = 0
+    prefix_text = ""
+
+    for i in range(len(token_ids)):
+        offsets.append(len(text))
+        new_text = tokenizer.decode(
+            token_ids[prefix_offset : i + 1], skip_special_tokens=True
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            text += new_text[len(prefix_text) :]
+            prefix_offset, read_offset = read_offset, i + 1
+            prefix_text = tokenizer.decode(
+                token_ids[prefix_offset:read_offset], skip_special_tokens=True
+            )
+
+    if read_offset < len(token_ids):
+        new_text = tokenizer.decode(token_ids[prefix_offset:], skip_special_tokens=True)
+        text += new_text[len(prefix_text) :]
+
+    return text, offsets
+
+
+@functools.lru_cache(maxsize=None)
+def get_vocab_tokens(tokenizer, vocab_size):
+    """Return the token string of every id in the model vocabulary.
+
+    The model vocabulary can be larger than the tokenizer one; the extra ids
+    have no token and are mapped to an empty string.
+    """
+    tokens = tokenizer.convert_ids_to_tokens(list(range(vocab_size)))
+    return [tok or "" for tok in tokens]
+
+
+def get_watch_ids(tokenizer, words):
+    """Return the ids of the single-token variants of the watched words.
+
+    Each word is watched with and without a leading space, and capitalized
+    or not; variants split into several tokens have no probability at a
+    single step and are left out.
+    """
+    watch_ids = []
+    for word in words:
+        variants = dict.fromkeys(
+            [word, f" {word}", word.capitalize(), f" {word.capitalize()}"]
+        )
+        ids = [tokenizer(v, add_special_tokens=False)["input_ids"] for v in variants]
+        ids = [i[0] for i in ids if len(i) == 1]
+        if not ids:
+            print(f"No single-token variant of {word}, it will not be watched")
+        watch_ids.extend(i for i in ids if i not in watch_ids)
+
+    return watch_ids
+
+
+def get_watch_logprobs(logprobs, watch_ids):
+    """Return the logprobs and full-vocabulary ranks of the watched tokens."""
+    watch_logprobs = logprobs[..., watch_ids]
+    watch_ranks = torch.stack(
+        [
+            (logprobs > watch_logprobs[..., i : i + 1]).sum(dim=-1)
+            for i in range(len(watch_ids))
+        ],
+        dim=-1,
+    )
+    return watch_logprobs, watch_ranks
+
+
+def compute_step_logprobs(
+    scores, generated_ids, top_k, watch_ids=None, watch_capture=None
+):
+    """Compute the logprobs of every generation step in a single pass.
+
+    scores are the per-step logits returned by generate (or a tensor of
+    shape (batch, steps, vocab)) and generated_ids the
+    (batch, steps) tokens chosen at each step. Returns nested lists, indexed
+    by [row][step], of the chosen token logprobs, their rank in the whole
+    vocabulary, and the top-k logprobs and token ids, followed by the
+    logprobs and ranks of the watched tokens if there are any. Those are
+    taken from watch_capture instead of scores when it is given.
+    """
+    if not torch.is_tensor(scores):
+        scores = torch.stack(scores, dim=1)
+    logprobs = torch.log_softmax(scores, dim=-1)
+
+    token_logprobs = logprobs.gather(-1, generated_ids.unsqueeze(-1))
+    ranks = (logprobs > token_logprobs).sum(dim=-1, keepdim=True)
+    topk_logprobs, topk_indices = torch.topk(logprobs, k=top_k, dim=-1)
+    watch_logprobs = watch_ranks = None
+    if watch_capture is not None:
+        watch_logprobs, watch_ranks = watch_capture.get_watch_logprobs()
+    elif watch_ids:
+        watch_logprobs, watch_ranks = get_watch_logprobs(logprobs, watch_ids)
+
+    return transfer_step_logprobs(
+        token_logprobs,
+        ranks,
+        topk_logprobs,
+        topk_indices,
+        top_k,
+        watch_logprobs,
+        watch_ranks,
+    )
+
+
+def transfer_step_logprobs(
+    token_logprobs,
+    ranks,
+    topk_logprobs,
+    topk_indices,
+    top_k,
+    watch_logprobs=None,
+    watch_ranks=None,
 ):
-    """Generate text and save logprobs for each token."""
+    """Move the (batch, steps, ...) step logprobs to the host as nested lists."""
+    tensors = [token_logprobs, ranks, topk_logprobs, topk_indices]
+    sizes = [1, 1, top_k, top_k]
+    if watch_logprobs is not None:
+        tensors += [watch_logprobs, watch_ranks]
+        sizes += [watch_logprobs.shape[-1]] * 2
+
+    # pack everything into one float32 tensor so that there is a single
+    # device to host transfer (ids and ranks are exact below 2**24)
+    packed = torch.cat([t.float() for t in tensors], dim=-1).cpu()
+
+    token_logprobs, ranks, topk_logprobs, topk_indices, *watch = packed.split(
+        sizes, dim=-1
+    )
+
+    step_logprobs = (
+        token_logprobs.squeeze(-1).tolist(),
+        ranks.squeeze(-1).int().tolist(),
+        topk_logprobs.tolist(),
+        topk_indices.int().tolist(),
+    )
+    if watch:
+        step_logprobs += (watch[0].tolist(), watch[1].int().tolist())
+
+    return step_logprobs
+
+
+def get_warpers(generation_config, **kwargs):
+    """Return the sampling warpers generate applies for a generation config.
+
+    kwargs override the values of generation_config, as they do in generate.
+    """
+    params = {
+        name: kwargs.get(name, getattr(generation_config, name))
+        for name in ("temperature", "top_k", "top_p", "min_p")
+    }
+
+    warpers = LogitsProcessorList()
+    if params["temperature"] is not None and params["temperature"] != 1.0:
+        warpers.append(TemperatureLogitsWarper(params["temperature"]))
+    if params["top_k"] is not None and params["top_k"] != 0:
+        warpers.append(TopKLogitsWarper(top_k=params["top_k"]))
+    if params["top_p"] is not None and params["top_p"] < 1.0:
+        warpers.append(TopPLogitsWarper(top_p=params["top_p"]))
+    if params["min_p"] is not None:
+        warpers.append(MinPLogitsWarper(min_p=params["min_p"]))
+
+    return warpers
+
+
+class WatchCapture(LogitsProcessor):
+    """Logits processor recording the watched tokens before sampling warpers.
+
+    Top-k and top-p give -inf to every token outside the sampled mass, so
+    the logprobs and ranks of the watched tokens are taken from the logits
+    as they are before the warpers, like those of score_texts. generate
+    applies its own warpers after the given logits processors.
+    """
+
+    def __init__(self, watch_ids):
+        self.watch_ids = watch_ids
+        self.watch_logprobs = []
+        self.watch_ranks = []
+
+    def __call__(self, input_ids, scores):
+        watch_scores = scores[..., self.watch_ids]
+        # logprobs and ranks without a full log_softmax copy of the scores
+        self.watch_logprobs.append(
+            watch_scores - torch.logsumexp(scores, dim=-1, keepdim=True)
+        )
+        self.watch_ranks.append(
+            torch.stack(
+                [
+                    (scores > watch_scores[..., i : i + 1]).sum(dim=-1)
+                    for i in range(len(self.watch_ids))
+                ],
+                dim=-1,
+            )
+        )
+        return scores
+
+    def get_watch_logprobs(self):
+        """Return the (batch, steps, watched) logprobs and ranks captured."""
+        return (
+            torch.stack(self.watch_logprobs, dim=1),
+            torch.stack(self.watch_ranks, dim=1),
+        )
+
+
+class TopKCapture(LogitsProcessor):
+    """Logits processor reducing each generation step to its top-k on the fly.
+
+    Keeping output_scores holds a full-vocabulary row per step and sequence
+    until generation ends. Instead, this processor applies the sampling
+    warpers itself (generate's own warpers must then be disabled), keeps the
+    top-k of the resulting distribution, and only holds on to the full row of
+    the current step until the next call reveals which token was sampled
+    from it. Watched tokens are recorded before the warpers (see
+    WatchCapture).
+    """
+
+    def __init__(self, top_k, warpers, watch_ids=None):
+        self.top_k = top_k
+        self.warpers = warpers
+        self.watch_capture = WatchCapture(watch_ids) if watch_ids else None
+
+        self.pending = None
+        self.token_logprobs = []
+        self.ranks = []
+        self.topk_logprobs = []
+        self.topk_indices = []
+
+    def __call__(self, input_ids, scores):
+        if self.pending is not None:
+            self.resolve(input_ids[:, -1])
+
+        if self.watch_capture is not None:
+            self.watch_capture(input_ids, scores)
+        scores = self.warpers(input_ids, scores)
+        logprobs = torch.log_softmax(scores, dim=-1)
+        topk_logprobs, topk_indices = torch.topk(logprobs, k=self.top_k, dim=-1)
+        self.topk_logprobs.append(topk_logprobs)
+        self.topk_indices.append(topk_indices)
+        self.pending = logprobs
+
+        return scores
+
+    def resolve(self, token_ids):
+        """Record the logprob and rank of the tokens sampled at the last step."""
+        token_logprobs = self.pending.gather(-1, token_ids.unsqueeze(-1))
+        self.token_logprobs.append(token_logprobs)
+        self.ranks.append((self.pending > token_logprobs).sum(dim=-1, keepdim=True))
+        self.pending = None
+
+    def get_step_logprobs(self, sequences):
+        """Return the captured step logprobs, as compute_step_logprobs does."""
+        if self.pending is not None:
+            self.resolve(sequences[:, -1])
+
+        watch = [None, None]
+        if self.watch_capture is not None:
+            watch = self.watch_capture.get_watch_logprobs()
+
+        return transfer_step_logprobs(
+            torch.stack(self.token_logprobs, dim=1),
+            torch.stack(self.ranks, dim=1),
+            torch.stack(self.topk_logprobs, dim=1),
+            torch.stack(self.topk_indices, dim=1),
+            self.top_k,
+            *watch,
+        )
+
+
+class PrefillTimer(LogitsProcessor):
+    """Logits processor recording when generate gets its first logits.
+
+    The time until then is the prefill of the prompts, the rest of the
+    generate call the decoding of the following tokens.
+    """
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.first_step = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_step is None:
+            self.telemetry.sync()
+            self.first_step = time.perf_counter()
+        return scores
+
+
+def build_records(
+    vocab,
+    token_ids,
+    offsets,
+    token_logprobs,
+    ranks,
+    topk_logprobs,
+    topk_indices,
+    watch_logprobs=None,
+    watch_ranks=None,
+    watch_ids=None,
+):
+    """Build the per-step records of a generated sequence.
+
+    With watched tokens, each record also lists the logprob and rank of
+    every watched token, whether it is in the top-k or not.
+    """
+    results = []
+    for i, token_id in enumerate(token_ids):
+        # get top-k alternatives
+        top_k_list = [
+            {"token": vocab[idx].replace("Ġ", ""), "logprob": lp}
+            for idx, lp in zip(topk_indices[i], topk_logprobs[i])
+            if lp != float("-inf")
+        ]
+
+        results.append(
+            {
+                "step": i,
+                "token": vocab[token_id],
+                "logprob": token_logprobs[i],
+                "rank": ranks[i],
+                "top_k": top_k_list,
+                "offset": offsets[i],
+            }
+        )
+        if watch_ids:
+            results[-1]["watch"] = [
+                {"token": vocab[idx], "logprob": lp, "rank": rank}
+                for idx, lp, rank in zip(watch_ids, watch_logprobs[i], watch_ranks[i])
+            ]
+
+    return results
+
+
+def get_sample_id(prompt_id, sample, num_samples=1):
+    """Return the id under which a sample of a prompt is saved."""
+    return prompt_id if num_samples == 1 else f"{prompt_id}_s{sample}"
+
+
+def prefill_prompts(model, inputs, past_key_values=None):
+    """Run all but the last token of a batch of prompts through the model.
+
+    Returns the KV cache of the prompts (extending past_key_values if it
+    already holds their beginning), from which generate only has to process
+    the last prompt token.
+    """
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs["attention_mask"]
+    position_ids = get_position_ids(attention_mask)
+
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    start = past_key_values.get_seq_length()
+    end = input_ids.shape[1] - 1
+
+    if start < end:
+        with torch.no_grad():
+            model(
+                input_ids=input_ids[:, start:end],
+                attention_mask=attention_mask[:, :end],
+                position_ids=position_ids[:, start:end],
+                past_key_values=past_key_values,
+                cache_position=torch.arange(start, end, device=input_ids.device),
+                use_cache=True,
+            )
+
+    return past_key_values
+
+
+def sample_sequences(
+    device,
+    model,
+    tokenizer,
+    prompts,
+    num_sequences=1,
+    top_k=30,
+    max_new_tokens=512,
+    capture="stream",
+    prompt_cache=None,
+    watch_ids=None,
+    telemetry=None,
+    stop_strings=None,
+):
+    """Sample num_sequences sequences for each prompt in a single generate call.
+
+    Returns a dict mapping each prompt id to a list of (records, generated
+    text). With several sequences per prompt, the prompts are encoded once
+    and their cache is repeated for each sequence. The phases are timed in
+    telemetry, if given.
+
+    A sequence ends as soon as one of stop_strings appears in its text, the
+    other sequences of the batch going on. Its text and records are cut
+    before the stop string.
+    """
+    if telemetry is None:
+        telemetry = Telemetry(device)
+    prompt_ids = list(prompts)
+
     # tokenize input
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    with telemetry.phase("tokenize"):
+        past_key_values = None
+        if prompt_cache is not None:
+            inputs = prompt_cache.get_inputs(
+                tokenizer, [prompts[k] for k in prompt_ids], device
+            )
+            past_key_values = prompt_cache.get_cache(len(prompt_ids))
+        else:
+            inputs = tokenizer(
+                [prompts[k] for k in prompt_ids], return_tensors="pt", padding=True
+            ).to(device)
     input_len = inputs["input_ids"].shape[1]
+    telemetry.prompt_tokens.update(
+        zip(prompt_ids, inputs["attention_mask"].sum(dim=1).tolist())
+    )
+
+    if num_sequences > 1:
+        with telemetry.phase("prefill"):
+            past_key_values = prefill_prompts(model, inputs, past_key_values)
+            past_key_values.batch_repeat_interleave(num_sequences)
+            inputs = {
+                k: v.repeat_interleave(num_sequences, dim=0) for k, v in inputs.items()
+            }
+
+    cache_kwargs = {}
+    if past_key_values is not None:
+        cache_kwargs["past_key_values"] = past_key_values
+    if stop_strings:
+        # generate matches the stop strings on the tokens of each row
+        cache_kwargs.update({"stop_strings": stop_strings, "tokenizer": tokenizer})
 
     # generate text
-    print(f"Generating text for prompt {prompt_id}...")
+    print(f"Generating text for prompts {', '.join(prompt_ids)}...")
+    sampling = {"temperature": TEMPERATURE, "top_p": TOP_P}
+    topk_capture = watch_capture = None
+    if capture == "stream":
+        topk_capture = TopKCapture(
+            top_k, get_warpers(model.generation_config, **sampling), watch_ids
+        )
+        # the capture applies the sampling warpers in place of generate
+        sampling = {"temperature": 1.0, "top_k": 0, "top_p": 1.0, "min_p": None}
+    elif watch_ids:
+        watch_capture = WatchCapture(watch_ids)
+
+    prefill_timer = PrefillTimer(telemetry)
+    processors = [prefill_timer] + [
+        p for p in (topk_capture, watch_capture) if p is not None
+    ]
+    telemetry.sync()
+    start = time.perf_counter()
     outputs = model.generate(
         **inputs,
         max_new_tokens=max_new_tokens,
         do_sample=True,
-        temperature=1.0,
-        top_p=0.9,
+        **sampling,
         pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+        logits_processor=LogitsProcessorList(processors),
         return_dict_in_generate=True,
-        output_scores=True,
+        output_scores=topk_capture is None,
+        **cache_kwargs,
     )
+    telemetry.sync()
+    end = time.perf_counter()
+    first_step = prefill_timer.first_step or end
+    telemetry.add("prefill", first_step - start)
+    telemetry.add("decode", end - first_step)
 
-    sequences = outputs.sequences
-    scores = outputs.scores
+    with telemetry.phase("postprocess"):
+        sequences = outputs.sequences
+        eos_ids = get_eos_ids(model, tokenizer)
+        if topk_capture is not None:
+            step_logprobs = topk_capture.get_step_logprobs(sequences)
+        else:
+            step_logprobs = compute_step_logprobs(
+                outputs.scores,
+                sequences[:, input_len:],
+                top_k,
+                watch_capture=watch_capture,
+            )
+        vocab = get_vocab_tokens(tokenizer, model.config.vocab_size)
 
-    generated_ids = sequences[0][input_len:]
+        generations = {prompt_id: [] for prompt_id in prompt_ids}
+        for row in range(sequences.shape[0]):
+            generated_ids = sequences[row][input_len:]
+            generated_ids = generated_ids[: get_sequence_length(generated_ids, eos_ids)]
 
-    results = []
-    for i, (token_id, logits) in enumerate(zip(generated_ids, scores)):
-        logprobs = torch.log_softmax(logits[0], dim=-1)
+            token_ids = generated_ids.tolist()
+            generated_text, offsets = decode_incremental(tokenizer, token_ids)
+            if stop_strings:
+                length = get_stop_length(generated_text, offsets, stop_strings)
+                if length is not None:
+                    telemetry.stopped += 1
+                    if length < len(token_ids):
+                        generated_text = generated_text[: offsets[length]]
+                    token_ids = token_ids[:length]
+                    offsets = offsets[:length]
 
-        token_logprob = logprobs[token_id].item()
+            results = build_records(
+                vocab,
+                token_ids,
+                offsets,
+                *(values[row] for values in step_logprobs),
+                watch_ids=watch_ids,
+            )
 
-        # get top-k alternatives
-        topk_logprobs, topk_indices = torch.topk(logprobs, k=top_k)
-        topk_tokens = tokenizer.convert_ids_to_tokens(topk_indices.tolist())
+            generations[prompt_ids[row // num_sequences]].append(
+                (results, generated_text)
+            )
 
-        top_k_list = [
-            {"token": tok.replace("Ġ", ""), "logprob": lp.item()}
-            for tok, lp in zip(topk_tokens, topk_logprobs)
-            if lp.item() != float("-inf")
-        ]
+    return generations
 
-        context = tokenizer.decode(generated_ids[:i])
 
-        results.append(
-            {
-                "step": i,
-                "token": tokenizer.convert_ids_to_tokens([token_id])[0],
-                "logprob": token_logprob,
-                "top_k": top_k_list,
-                "context": context,
-            }
+def generate_with_logprobs(
+    device,
+    model,
+    tokenizer,
+    prompts,
+    top_k=30,
+    max_new_tokens=512,
+    capture="stream",
+    prompt_cache=None,
+    num_samples=1,
+    extra_samples=0,
+    max_retries=3,
+    watch_ids=None,
+    telemetry=None,
+    stop_strings=None,
+):
+    """Generate text and logprobs for each token of a batch of prompts.
+
+    Returns a dict mapping the id of each sample (see get_sample_id) to its
+    (records, generated text). Instead of the decoded context, each record
+    holds the offset of its token in the generated text. With
+    capture="stream", step logprobs are reduced to their top-k during
+    decoding; with capture="scores", they are computed from the full scores
+    kept by generate. A PromptCache holding the prefix shared by the prompts
+    saves encoding it again.
+
+    extra_samples spare sequences are drawn for each prompt, in the same
+    generate call, to replace samples with no or but few text. Samples still
+    missing are then drawn again together, at most max_retries times.
+
+    watch_ids are token ids whose logprob and rank are recorded at every
+    step, whether they are in the top-k or not. The phases, retries and
+    rejected sequences are recorded in telemetry, if given. Sequences end
+    at the first of stop_strings (see sample_sequences).
+    """
+    if telemetry is None:
+        telemetry = Telemetry(device)
+    samples = {prompt_id: [] for prompt_id in prompts}
+    pending = dict(prompts)
+
+    for attempt in range(max_retries + 1):
+        num_sequences = (
+            max(num_samples - len(samples[k]) for k in pending) + extra_samples
+        )
+        candidates = sample_sequences(
+            device,
+            model,
+            tokenizer,
+            pending,
+            num_sequences,
+            top_k,
+            max_new_tokens,
+            capture,
+            prompt_cache,
+            watch_ids,
+            telemetry,
+            stop_strings,
         )
+        if attempt > 0:
+            telemetry.retries += 1
+
+        for prompt_id, sequences in candidates.items():
+            for results, generated_text in sequences:
+                if len(samples[prompt_id]) == num_samples:
+                    break
+                if len(generated_text) < 20:
+                    print(
+                        f"No or but few text generated for prompt {prompt_id} "
+                        f"({len(generated_text)} characters once cut at any stop string)"
+                    )
+                    telemetry.rejected += 1
+                    continue
+                samples[prompt_id].append((results, generated_text))
 
-    generated_text = tokenizer.decode(generated_ids, skip_special_tokens=True)
+        pending = {k: v for k, v in pending.items() if len(samples[k]) < num_samples}
+        if not pending:
+            break
+        if attempt < max_retries:
+            print(f"Redoing generation for prompts {', '.join(pending)}")
 
-    if len(generated_text) < 20:
+    for prompt_id in pending:
         print(
-            f"No or but few text generated for prompt {prompt_id}, redoing generation"
+            f"Giving up on prompt {prompt_id} after {max_retries} retries, "
+            f"{len(samples[prompt_id])}/{num_samples} samples generated"
         )
-        return generate_with_logprobs(
-            model, tokenizer, prompt_id, prompt, top_k, max_new_tokens
+        telemetry.dropped[prompt_id] = num_samples - len(samples[prompt_id])
+
+    generations = {}
+    for prompt_id, prompt_samples in samples.items():
+        for sample, generation in enumerate(prompt_samples):
+            sample_id = get_sample_id(prompt_id, sample, num_samples)
+            generations[sample_id] = generation
+            telemetry.samples[sample_id] = prompt_id
+
+    return generations
+
+
+def score_texts(
+    device,
+    model,
+    tokenizer,
+    prompts,
+    texts,
+    top_k=30,
+    prompt_cache=None,
+    watch_ids=None,
+    telemetry=None,
+    token_ids=None,
+):
+    """Compute the logprobs of existing texts, each following its prompt.
+
+    Every text of the batch is scored in a single forward pass instead of
+    being generated token by token, and gets the same records as a
+    generated one. The logprobs are those of the model distribution itself,
+    as no sampling warper applies to a text that is not sampled, so they
+    differ from the warped ones saved for generated texts.
+    Returns dict id → (records, text). The phases are timed in telemetry,
+    if given, the forward pass as the prefill. token_ids, dict id → token
+    ids, gives texts already tokenized, which texts may then leave out.
+    """
+    if telemetry is None:
+        telemetry = Telemetry(device)
+    ids = list(prompts)
+    with telemetry.phase("tokenize"):
+        prompt_ids = [tokenizer(prompts[k])["input_ids"] for k in ids]
+        if token_ids is None:
+            token_ids = {
+                k: tokenizer(texts[k], add_special_tokens=False)["input_ids"]
+                for k in ids
+            }
+        text_ids = [token_ids[k] for k in ids]
+        input_ids = [p + t for p, t in zip(prompt_ids, text_ids)]
+
+        past_key_values = None
+        if prompt_cache is not None:
+            inputs = prompt_cache.pad_inputs(input_ids, device)
+            past_key_values = prompt_cache.get_cache(len(ids))
+        else:
+            inputs = pad_token_ids(input_ids, tokenizer.pad_token_id, device)
+    telemetry.prompt_tokens.update(zip(ids, map(len, prompt_ids)))
+    telemetry.samples.update(zip(ids, ids))
+
+    start = past_key_values.get_seq_length() if past_key_values is not None else 0
+    end = inputs["input_ids"].shape[1]
+    max_len = max(len(t) for t in text_ids)
+
+    with torch.no_grad(), telemetry.phase("prefill"):
+        logits = model(
+            input_ids=inputs["input_ids"][:, start:],
+            attention_mask=inputs["attention_mask"],
+            position_ids=get_position_ids(inputs["attention_mask"])[:, start:],
+            past_key_values=past_key_values,
+            cache_position=torch.arange(start, end, device=device),
+            # only the positions predicting a text token are needed
+            logits_to_keep=max_len + 1,
+        ).logits
+
+    telemetry.sync()
+    postprocess_start = time.perf_counter()
+    # texts end flush against the right edge: the last len(t) tokens of a
+    # row are predicted by the logits of the positions just before them
+    # logprobs are computed in float32 whatever the precision of the model
+    scores = logits.new_zeros(
+        (len(ids), max_len, logits.shape[-1]), dtype=torch.float32
+    )
+    target_ids = torch.full(
+        (len(ids), max_len), tokenizer.pad_token_id, device=logits.device
+    )
+    for i, t in enumerate(text_ids):
+        scores[i, : len(t)] = logits[i, max_len - len(t) : max_len]
+        target_ids[i, : len(t)] = torch.tensor(t, device=logits.device)
+    del logits
+
+    step_logprobs = compute_step_logprobs(scores, target_ids, top_k, watch_ids)
+    vocab = get_vocab_tokens(tokenizer, scores.shape[-1])
+
+    scored = {}
+    for i, k in enumerate(ids):
+        text, offsets = decode_incremental(tokenizer, text_ids[i])
+        records = build_records(
+            vocab,
+            text_ids[i],
+            offsets,
+            *(values[i] for values in step_logprobs),
+            watch_ids=watch_ids,
         )
+        scored[k] = (records, text)
+    telemetry.add("postprocess", time.perf_counter() - postprocess_start)
 
-    model_id_str = model_id.split("/")[1]
+    return scored
 
-    if not os.path.exists(f"results/{model_id_str}/{level}/logits"):
-        os.makedirs(f"results/{model_id_str}/{level}/logits")
 
-    if not os.path.exists(f"results/{model_id_str}/{level}/gen"):
-        os.makedirs(f"results/{model_id_str}/{level}/gen")
+def save_results(
+    model_id,
+    level,
+    text_type,
+    gen_type,
+    prompt_id,
+    results,
+    generated_text,
+    output_format="jsonl",
+    score_source=None,
+    telemetry=None,
+):
+    """Write the token logprobs and the generated text of a prompt.
 
-    with open(
-        f"results/{model_id_str}/{level}/logits/token_logits_{model_id_str}_{prompt_id}_{text_type}_{gen_type}.jsonl",
-        "w",
-        encoding="utf-8",
-    ) as f:
-        for res in results:
-            f.write(json.dumps(res, ensure_ascii=False) + "\n")
+    Returns the paths of the written files. The two writes are timed in
+    telemetry, if given.
+    """
+    if telemetry is None:
+        telemetry = Telemetry("cpu")
+    logits_path, gen_path = get_output_paths(
+        model_id, level, text_type, gen_type, prompt_id, output_format, score_source
+    )
+
+    os.makedirs(os.path.dirname(logits_path), exist_ok=True)
+    os.makedirs(os.path.dirname(gen_path), exist_ok=True)
+
+    with telemetry.phase("write_logits"):
+        if output_format == "parquet":
+            write_logits(
+                logits_path,
+                results,
+                generated_text,
+                get_model_name(model_id),
+                level,
+                text_type,
+                gen_type,
+                prompt_id,
+            )
+        else:
+            with atomic_open(logits_path) as f:
+                for res in results:
+                    f.write(json.dumps(res, ensure_ascii=False) + "\n")
 
-    with open(
-        f"results/{model_id_str}/{level}/gen/generated_text_{model_id_str}_{prompt_id}_{text_type}_{gen_type}.txt",
-        "w",
-        encoding="utf-8",
-    ) as f:
+    with telemetry.phase("write_text"), atomic_open(gen_path) as f:
         f.write(generated_text)
 
+    return logits_path, gen_path
 
-def main(level, text_type, gen_type, model_id, top_k=30, max_new_tokens=512):
+
+def get_prompts(level, text_type, gen_type):
+    """Build the prompt of every corpus text of a configuration."""
     corpus = load_corpus(
         level, text_type, extract=True if gen_type == "continuation" else False
     )
@@ -123,16 +1251,953 @@ def main(level, text_type, gen_type, model_id, top_k=30, max_new_tokens=512):
     for text_id, content in corpus.items():
         prompts[text_id] = get_prompt(gen_type, text_type, level, content)
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
+    return prompts
+
+
+def get_scoring_inputs(level, text_type, gen_type, score_source):
+    """Build the prompts and the texts to score for a configuration.
+
+    With score_source "corpus", the corpus texts are scored: the remainder of
+    each text after its extract for continuation, the whole text for
+    generation. As a generation prompt holds the whole text it asks to
+    imitate, each text is scored after the prompt of another story, so that
+    it is never part of its own prompt. Otherwise score_source is
+    a model whose generated texts are scored, each with the prompt it was
+    generated from.
+    Returns the (prompts, texts) dicts, keyed by the same ids.
+    """
+    is_cont = gen_type == "continuation"
+    # continuation prompts hold the extract of a text, generation ones all of it
+    corpus = load_corpus(level, text_type, split=is_cont)
+
+    prompts = {}
+    texts = {}
+
+    if score_source == "corpus":
+        other_texts = {}
+        if not is_cont:
+            # the same version of the next story, which shares no text with it;
+            # stories are told apart by title, as their versions may not share
+            # a num
+            rows = list(
+                select_texts(level=level, text_type=text_type)[
+                    ["text_id", "title", "version"]
+                ].itertuples(index=False)
+            )
+            stories = sorted({title for _, title, _ in rows})
+            by_story = {}
+            for text_id, title, version in rows:
+                by_story.setdefault(title, {})[version] = text_id
+            if len(stories) > 1:
+                for text_id, title, version in rows:
+                    story = by_story[stories[(stories.index(title) + 1) % len(stories)]]
+                    other_texts[text_id] = story.get(
+                        version, next(iter(story.values()))
+                    )
+
+        for text_id in sorted(corpus):
+            if is_cont:
+                content, text = corpus[text_id]
+            elif text_id in other_texts:
+                # the whole text, after the prompt of another story
+                content, text = corpus[other_texts[text_id]], corpus[text_id]
+            else:
+                print(f"No other story to prompt {text_id} with")
+                continue
+            if not text.strip():
+                print(f"Nothing to score after the extract of {text_id}")
+                continue
+            prompts[text_id] = get_prompt(gen_type, text_type, level, content)
+            texts[text_id] = text
+
+        return prompts, texts
+
+    source_name = get_model_name(score_source)
+    for text_id, content in corpus.items():
+        if is_cont:
+            content = content[0]
+        prompt = get_prompt(gen_type, text_type, level, content)
+
+        _, gen_path = get_output_paths(source_name, level, text_type, gen_type, text_id)
+        gen_dir = os.path.dirname(gen_path)
+        prefix = f"generated_text_{source_name}_{text_id}"
+        suffix = f"_{text_type}_{gen_type}.txt"
+        if not os.path.isdir(gen_dir):
+            continue
+        for filename in sorted(os.listdir(gen_dir)):
+            if not (filename.startswith(prefix) and filename.endswith(suffix)):
+                continue
+            # the generated texts of a prompt, with or without a sample suffix
+            sample_id = text_id + filename[len(prefix) : -len(suffix)]
+            if sample_id != text_id and not re.fullmatch(
+                rf"{re.escape(text_id)}_s\d+", sample_id
+            ):
+                continue
+            with open(os.path.join(gen_dir, filename), encoding="utf-8") as f:
+                text = f.read()
+            if text.strip():
+                prompts[sample_id] = prompt
+                texts[sample_id] = text
+
+    return prompts, texts
+
+
+def generate_batches(
+    device,
+    model,
+    tokenizer,
+    level,
+    text_type,
+    gen_type,
+    prompts,
+    top_k=30,
+    max_new_tokens=512,
+    batch_size=1,
+    capture="stream",
+    prefix_cache=True,
+    num_samples=1,
+    extra_samples=0,
+    max_retries=3,
+    texts=None,
+    score_source=None,
+    watch_ids=None,
+    stop_strings=None,
+):
+    """Generate the prompts of a configuration batch by batch.
+
+    Yields the prompt ids of each batch, its generations (see
+    generate_with_logprobs) and its metrics (see Telemetry.get_metrics).
+    With texts, the texts of score_source are scored after their prompts
+    instead of generating new ones, and stop_strings do not apply.
+    """
+    prompt_cache = None
+    if prefix_cache:
+        prompt_cache = PromptCache(model, tokenizer, prompts)
+        print(f"Cached a prefix of {len(prompt_cache.prefix_ids)} tokens")
+
+    if texts is None:
+        batches = get_batches(tokenizer, prompts, batch_size)
+    else:
+        # batch on the length of the whole scored sequence
+        batches = get_batches(
+            tokenizer, {k: prompts[k] + texts[k] for k in prompts}, batch_size
+        )
+
+    for batch in batches:
+        telemetry = Telemetry(device)
+        if texts is None:
+            print(
+                f"Generating with prompts {', '.join(batch)}, level {level}, text_type {text_type}, gen_type {gen_type}"
+            )
+            generations = generate_with_logprobs(
+                device,
+                model,
+                tokenizer,
+                batch,
+                top_k,
+                max_new_tokens,
+                capture,
+                prompt_cache,
+                num_samples,
+                extra_samples,
+                max_retries,
+                watch_ids,
+                telemetry,
+                stop_strings,
+            )
+        else:
+            print(
+                f"Scoring texts {', '.join(batch)} of {score_source}, level {level}, text_type {text_type}, gen_type {gen_type}"
+            )
+            generations = score_texts(
+                device,
+                model,
+                tokenizer,
+                {k: prompts[k] for k in batch},
+                {k: texts[k] for k in batch},
+                top_k,
+                prompt_cache,
+                watch_ids,
+                telemetry,
+            )
+
+        yield list(batch), generations, telemetry.get_metrics()
+
+
+def save_batch(
+    model_id,
+    level,
+    text_type,
+    gen_type,
+    manifest,
+    manifest_path,
+    batch,
+    generations,
+    metrics,
+    output_format="jsonl",
+    score_source=None,
+):
+    """Save the generations of a batch and record them in the manifest.
+
+    The metrics of each saved sample are appended to the metrics file of
+    the configuration (see get_metrics_path). Returns the totals of the
+    batch (see add_metrics).
+    """
+    seconds = metrics["seconds"]
+    generated = sum(len(results) for results, _ in generations.values())
+    lines = []
+    totals = {"phases": dict(metrics["phases"]), "write_phases": {}}
+    for sample_id, (results, generated_text) in generations.items():
+        writes = Telemetry("cpu")
+        paths = save_results(
+            model_id,
+            level,
+            text_type,
+            gen_type,
+            sample_id,
+            results,
+            generated_text,
+            output_format,
+            score_source,
+            writes,
+        )
+        for phase, phase_seconds in writes.phases.items():
+            totals["write_phases"][phase] = (
+                totals["write_phases"].get(phase, 0.0) + phase_seconds
+            )
+
+        prompt_id = metrics["samples"].get(sample_id, sample_id)
+        lines.append(
+            {
+                "sample_id": sample_id,
+                "prompt_id": prompt_id,
+                "batch": batch,
+                "prompt_tokens": metrics["prompt_tokens"].get(prompt_id),
+                "generated_tokens": len(results),
+                # phases are shared by the batch, writes are the sample's own
+                "phases": {
+                    phase: round(phase_seconds, 4)
+                    for phase, phase_seconds in metrics["phases"].items()
+                },
+                "write_phases": {
+                    phase: round(phase_seconds, 4)
+                    for phase, phase_seconds in writes.phases.items()
+                },
+                "batch_tokens_per_s": round(generated / seconds, 2),
+                "retries": metrics["retries"],
+                "rejected": metrics["rejected"],
+                "stopped": metrics["stopped"],
+                "process_peak_rss_mib": round(metrics["process_peak_rss_mib"], 1),
+                "peak_device_mib": (
+                    round(metrics["peak_device_mib"], 1)
+                    if metrics["peak_device_mib"] is not None
+                    else None
+                ),
+                "completed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+        )
+        manifest["completed"][sample_id] = {
+            "files": {
+                os.path.relpath(path, os.path.dirname(manifest_path)): (
+                    get_file_hash(path)
+                )
+                for path in paths
+            },
+            "batch_size": len(batch),
+            "seconds": round(seconds, 3),
+            "completed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+
+    # prompts given up on stay in the manifest until a later run completes them
+    dropped = manifest.setdefault("dropped", {})
+    for prompt_id in batch:
+        dropped.pop(prompt_id, None)
+    for prompt_id, missing in metrics["dropped"].items():
+        dropped[prompt_id] = {
+            "missing_samples": missing,
+            "dropped_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+
+    save_manifest(manifest_path, manifest)
+    with open(get_metrics_path(manifest_path), "a", encoding="utf-8") as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    totals.update(
+        {
+            "samples": len(generations),
+            "prompt_tokens": sum(metrics["prompt_tokens"].values()),
+            "generated_tokens": generated,
+            "retries": metrics["retries"],
+            "rejected": metrics["rejected"],
+            "stopped": metrics["stopped"],
+            "dropped": len(metrics["dropped"]),
+            "peak_device_mib": metrics["peak_device_mib"],
+        }
+    )
+    return totals
+
+
+def get_generations_size(generations):
+    """Estimate the memory held by the generations of a batch, in bytes."""
+    size = 0
+    for results, generated_text in generations.values():
+        size += len(generated_text)
+        for record in results:
+            entries = 1 + len(record["top_k"]) + len(record.get("watch") or ())
+            size += entries * ENTRY_BYTES
+    return size
+
+
+class ResultWriter:
+    """Save batches in a background thread while the next ones generate.
+
+    submit takes the arguments of save_batch and returns at once, the
+    serialization and writing of the files being left to the thread. Batches
+    wait in a queue of at most max_bytes (see get_generations_size): once it
+    is full, submit blocks until the thread catches up, so that a slow disk
+    holds generation back instead of growing memory. A batch larger than
+    max_bytes is still accepted once the queue is empty.
+
+    Used as a context manager, leaving it waits until every submitted batch
+    is saved, even on error, and raises the error of the thread, if any.
+    The totals of the saved batches are in totals (see add_metrics).
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.totals = {}
+        self.batches = []
+        self.queued_bytes = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except RuntimeError as e:
+            if exc_type is None:
+                raise
+            # the error that stopped generation is the one raised
+            if exc_value.__cause__ is not self.error:
+                print(f"{e}: {self.error!r}")
+
+    def submit(self, *args, **kwargs):
+        # generations are the eighth argument of save_batch
+        size = get_generations_size(kwargs.get("generations", args[7]))
+        with self.condition:
+            while (
+                self.error is None
+                and self.batches
+                and self.queued_bytes + size > self.max_bytes
+            ):
+                self.condition.wait()
+            self.check()
+            self.batches.append((size, args, kwargs))
+            self.queued_bytes += size
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batches and not self.closed:
+                    self.condition.wait()
+                if not self.batches:
+                    return
+                # the batch stays queued, and counted, until it is saved
+                size, args, kwargs = self.batches[0]
+
+            try:
+                metrics = save_batch(*args, **kwargs)
+            except BaseException as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                add_metrics(self.totals, metrics)
+                self.batches.pop(0)
+                self.queued_bytes -= size
+                self.condition.notify_all()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Saving the results failed") from self.error
+
+    def close(self):
+        """Wait until every submitted batch is saved, and stop the thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.check()
+
+
+def run_configuration(
+    device,
+    model,
+    tokenizer,
+    model_id,
+    level,
+    text_type,
+    gen_type,
+    prompts,
+    manifest,
+    top_k=30,
+    max_new_tokens=512,
+    batch_size=1,
+    capture="stream",
+    output_format="jsonl",
+    prefix_cache=True,
+    num_samples=1,
+    extra_samples=0,
+    max_retries=3,
+    texts=None,
+    score_source=None,
+    watch_ids=None,
+    write_buffer=256 * 2**20,
+    stop_strings=None,
+):
+    """Generate and save the results of the prompts of a configuration.
+
+    Each batch is saved by a ResultWriter, holding at most write_buffer
+    bytes of batches, while the next one generates. Returns the totals of
+    its batches (see add_metrics).
+    """
+    manifest_path = get_manifest_path(
+        model_id, level, text_type, gen_type, top_k, max_new_tokens, score_source
+    )
+
+    with ResultWriter(write_buffer) as writer:
+        for batch, generations, metrics in generate_batches(
+            device,
+            model,
+            tokenizer,
+            level,
+            text_type,
+            gen_type,
+            prompts,
+            top_k,
+            max_new_tokens,
+            batch_size,
+            capture,
+            prefix_cache,
+            num_samples,
+            extra_samples,
+            max_retries,
+            texts,
+            score_source,
+            watch_ids,
+            stop_strings,
+        ):
+            writer.submit(
+                model_id,
+                level,
+                text_type,
+                gen_type,
+                manifest,
+                manifest_path,
+                batch,
+                generations,
+                metrics,
+                output_format,
+                score_source,
+            )
+
+    return writer.totals
+
+
+def get_core_sets(num_workers):
+    """Split the cores available to the process into disjoint sets."""
+    cores = sorted(os.sched_getaffinity(0))
+    num_workers = min(num_workers, len(cores))
+    size, extra = divmod(len(cores), num_workers)
+
+    core_sets = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+
+    return core_sets
+
+
+def run_worker(
+    model_id, device, cores, tasks, options, watch_tokens, queue, precision=None
+):
+    """Generate a shard of the prompts in a worker process.
+
+    The worker is pinned to its cores, with as many torch threads as cores,
+    and loads its own copy of the model. Its generations are sent to the
+    parent process, which alone writes the results and manifests.
+    """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    model, tokenizer = load_model(model_id, device, precision)
+    watch_ids = get_watch_ids(tokenizer, watch_tokens) if watch_tokens else None
+
+    for lvl, txt, gen, prompts, texts in tasks:
+        for batch, generations, metrics in generate_batches(
+            device,
+            model,
+            tokenizer,
+            lvl,
+            txt,
+            gen,
+            prompts,
+            texts=texts,
+            watch_ids=watch_ids,
+            **options,
+        ):
+            queue.put((lvl, txt, gen, batch, generations, metrics))
+
+    # tell the parent that this worker is done
+    queue.put(None)
+
+
+def run_workers(
+    device,
+    model_id,
+    pending,
+    num_workers,
+    options,
+    output_format,
+    watch_tokens,
+    precision=None,
+    write_buffer=256 * 2**20,
+):
+    """Generate the pending configurations of a model with worker processes.
+
+    The prompts of each configuration are dealt between the workers, each
+    pinned to its own set of cores. Their batches are saved by a
+    ResultWriter, as in run_configuration. Returns the totals of their
+    batches (see add_metrics).
+    """
+    results_id = get_results_id(model_id, precision)
+    core_sets = get_core_sets(num_workers)
+    print(f"Generating with {len(core_sets)} workers on cores {core_sets}")
+
+    manifests = {}
+    shards = [[] for _ in core_sets]
+    for lvl, txt, gen, prompts, texts, manifest in pending:
+        manifests[lvl, txt, gen] = manifest
+        prompt_ids = list(prompts)
+        for i, shard in enumerate(shards):
+            ids = prompt_ids[i :: len(shards)]
+            if ids:
+                shard.append(
+                    (
+                        lvl,
+                        txt,
+                        gen,
+                        {k: prompts[k] for k in ids},
+                        {k: texts[k] for k in ids} if texts is not None else None,
+                    )
+                )
+
+    # spawn rather than fork, as torch is not fork-safe once threads run
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(
+                model_id,
+                device,
+                cores,
+                shard,
+                options,
+                watch_tokens,
+                queue,
+                precision,
+            ),
+        )
+        for cores, shard in zip(core_sets, shards)
+        if shard
+    ]
+    for worker in workers:
+        worker.start()
+
+    running = len(workers)
+    try:
+        with ResultWriter(write_buffer) as writer:
+            while running:
+                try:
+                    item = queue.get(timeout=10)
+                except Empty:
+                    if any(w.exitcode not in (None, 0) for w in workers):
+                        raise RuntimeError("A generation worker failed")
+                    continue
+
+                if item is None:
+                    running -= 1
+                    continue
+
+                lvl, txt, gen, batch, generations, metrics = item
+                writer.submit(
+                    results_id,
+                    lvl,
+                    txt,
+                    gen,
+                    manifests[lvl, txt, gen],
+                    get_manifest_path(
+                        results_id,
+                        lvl,
+                        txt,
+                        gen,
+                        options["top_k"],
+                        options["max_new_tokens"],
+                        options["score_source"],
+                    ),
+                    batch,
+                    generations,
+                    metrics,
+                    output_format,
+                    options["score_source"],
+                )
+    finally:
+        for worker in workers:
+            if worker.exitcode is None and running:
+                worker.terminate()
+            worker.join()
+
+    return writer.totals
+
+
+def read_records(model_id, level, text_type, gen_type, sample_id, score_source=None):
+    """Read the records of a saved sample, or None if it has no logits file."""
+    for output_format in ("parquet", "jsonl"):
+        logits_path, _ = get_output_paths(
+            model_id, level, text_type, gen_type, sample_id, output_format, score_source
+        )
+        if not os.path.exists(logits_path):
+            continue
+        if output_format == "parquet":
+            return read_logits(logits_path)
+        with open(logits_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    return None
+
+
+def compare_records(baseline, records):
+    """Return the absolute logprob errors of records against baseline records.
+
+    Both are scored on the same tokens (see validate_precision), so every
+    step is compared. Returns the errors of the chosen tokens and those of
+    the top-k tokens found in both records.
+    """
+    token_errors = []
+    topk_errors = []
+    for base, record in zip(baseline, records):
+        token_errors.append(abs(base["logprob"] - record["logprob"]))
+        base_topk = {tk["token"]: tk["logprob"] for tk in base["top_k"]}
+        topk_errors.extend(
+            abs(base_topk[tk["token"]] - tk["logprob"])
+            for tk in record["top_k"]
+            if tk["token"] in base_topk
+        )
+
+    return token_errors, topk_errors
 
-    model, tokenizer = load_model(model_id, device)
 
-    for k, v in prompts.items():
+def validate_precision(
+    device,
+    model_id,
+    precision,
+    configurations,
+    top_k=30,
+    batch_size=1,
+    score_source=None,
+):
+    """Compare the logprobs of a model at precision with those in float32.
+
+    The tokens saved by the default precision run, generated or scored from
+    score_source, are scored by the model at precision and in float32, so
+    that every step is compared on the same tokens, and a summary of the
+    absolute errors is printed.
+    """
+    batches = []
+    for lvl, txt, gen in configurations:
+        prompts, _ = get_scoring_inputs(lvl, txt, gen, score_source or model_id)
+        tokens = {}
+        for k in prompts:
+            records = read_records(model_id, lvl, txt, gen, k, score_source)
+            if records:
+                tokens[k] = [record["token"] for record in records]
+        ids = sorted(tokens, key=lambda k: len(tokens[k]))
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i : i + batch_size]
+            batches.append(
+                ({k: prompts[k] for k in batch}, {k: tokens[k] for k in batch})
+            )
+
+    print(f"Validation of {precision} against float32 for {model_id}:")
+    if not batches:
+        print("  No saved tokens to compare on")
+        return
+
+    scored = {}
+    for run_precision in (precision, "float32"):
+        model, tokenizer = load_model(model_id, device, run_precision)
+        scored[run_precision] = [
+            score_texts(
+                device,
+                model,
+                tokenizer,
+                prompts,
+                None,
+                top_k,
+                token_ids={
+                    k: tokenizer.convert_tokens_to_ids(t) for k, t in tokens.items()
+                },
+            )
+            for prompts, tokens in batches
+        ]
+        del model, tokenizer
+        get_vocab_tokens.cache_clear()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    texts = steps = 0
+    token_errors = []
+    topk_errors = []
+    for baseline, batch in zip(scored["float32"], scored[precision]):
+        for k, (records, _) in batch.items():
+            errors = compare_records(baseline[k][0], records)
+            texts += 1
+            steps += len(records)
+            token_errors.extend(errors[0])
+            topk_errors.extend(errors[1])
+
+    print(f"  {texts} texts, {len(token_errors)}/{steps} steps compared")
+    if not token_errors:
+        return
+    print(
+        f"  Chosen token logprobs: max abs error {max(token_errors):.4g}, "
+        f"mean {sum(token_errors) / len(token_errors):.4g}"
+    )
+    if topk_errors:
         print(
-            f"Generating with prompt {k}, level {level}, text_type {text_type}, gen_type {gen_type}"
+            f"  Top-k logprobs: max abs error {max(topk_errors):.4g}, "
+            f"mean {sum(topk_errors) / len(topk_errors):.4g}"
         )
-        generate_with_logprobs(device, model, tokenizer, k, v, top_k, max_new_tokens)
+
+
+def get_choices(values, choices):
+    """Return the values selected for a sweep axis, 'all' selecting every choice."""
+    if isinstance(values, str):
+        values = [values]
+    if "all" in values:
+        return list(choices)
+    return list(dict.fromkeys(values))
+
+
+def main(
+    level,
+    text_type,
+    gen_type,
+    model_id,
+    top_k=30,
+    max_new_tokens=512,
+    batch_size=1,
+    capture="stream",
+    output_format="jsonl",
+    resume=True,
+    prefix_cache=True,
+    num_samples=1,
+    extra_samples=0,
+    max_retries=3,
+    score_source=None,
+    watch_tokens=None,
+    workers=1,
+    precision=None,
+    validate=False,
+    write_buffer=256,
+    stop_strings=None,
+):
+    """Generate for every combination of levels, text types and generation types.
+
+    level, text_type, gen_type and model_id each take a value, a list of
+    values or "all". Each model is loaded once for all its configurations,
+    and freed before the next model is loaded. With score_source ("corpus"
+    or a model id), the texts of the source are scored instead.
+    watch_tokens are words whose probability is recorded at every step.
+    On CPU, workers > 1 shards the prompts between as many processes.
+    precision selects the weights of the models (see load_model); its
+    results are saved apart, and with validate its logprobs are compared
+    with float32 ones on the same texts. Results are saved in the background, with at most
+    write_buffer MiB of generations waiting to be written. Generated texts
+    end at the first of stop_strings, by default the delimiters of the
+    few-shot prompts; an empty list lets them run to max_new_tokens.
+    """
+    if stop_strings is None:
+        stop_strings = PROMPT_DELIMITERS
+    configurations = [
+        (lvl, txt, gen)
+        for lvl in get_choices(level, LEVELS)
+        for txt in get_choices(text_type, TEXT_TYPES)
+        for gen in get_choices(gen_type, GEN_TYPES)
+    ]
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+    if workers > 1 and device != "cpu":
+        print("Worker processes are only used on CPU, generating in one process")
+        workers = 1
+    if precision == "int8" and device != "cpu":
+        print("Dynamic int8 quantization is only available on CPU, using float16")
+        precision = None
+
+    model_ids = [model_id] if isinstance(model_id, str) else model_id
+
+    for model_id in model_ids:
+        results_id = get_results_id(model_id, precision)
+        pending = []
+        for lvl, txt, gen in configurations:
+            texts = None
+            if score_source is None:
+                prompts = get_prompts(lvl, txt, gen)
+            else:
+                # each scored text is saved under its own id
+                prompts, texts = get_scoring_inputs(lvl, txt, gen, score_source)
+                num_samples = 1
+
+            manifest_path = get_manifest_path(
+                results_id, lvl, txt, gen, top_k, max_new_tokens, score_source
+            )
+            manifest = load_manifest(
+                manifest_path,
+                {
+                    "model_id": model_id,
+                    "precision": precision,
+                    "level": lvl,
+                    "text_type": txt,
+                    "gen_type": gen,
+                    "top_k": top_k,
+                    "max_new_tokens": max_new_tokens,
+                    "score_source": score_source,
+                    "watch_tokens": watch_tokens,
+                    "stop_strings": stop_strings,
+                },
+            )
+
+            if resume:
+                completed = [
+                    k
+                    for k in prompts
+                    if all(
+                        is_completed(
+                            manifest, manifest_path, get_sample_id(k, i, num_samples)
+                        )
+                        for i in range(num_samples)
+                    )
+                ]
+                if completed:
+                    print(
+                        f"Skipping {len(completed)} prompts already completed for level {lvl}, text_type {txt}, gen_type {gen}"
+                    )
+                prompts = {k: v for k, v in prompts.items() if k not in completed}
+            else:
+                manifest["completed"] = {}
+
+            if prompts:
+                pending.append((lvl, txt, gen, prompts, texts, manifest))
+
+        if not pending:
+            print(f"Nothing left to generate with {model_id}")
+        elif workers > 1:
+            start = time.perf_counter()
+            totals = run_workers(
+                device,
+                model_id,
+                pending,
+                workers,
+                {
+                    "top_k": top_k,
+                    "max_new_tokens": max_new_tokens,
+                    "batch_size": batch_size,
+                    "capture": capture,
+                    "prefix_cache": prefix_cache,
+                    "num_samples": num_samples,
+                    "extra_samples": extra_samples,
+                    "max_retries": max_retries,
+                    "score_source": score_source,
+                    "stop_strings": stop_strings,
+                },
+                output_format,
+                watch_tokens,
+                precision,
+                write_buffer * 2**20,
+            )
+            print_summary(
+                totals,
+                time.perf_counter() - start,
+                # the largest peak among the workers
+                get_peak_rss(children=True),
+            )
+        else:
+            model, tokenizer = load_model(model_id, device, precision)
+            watch_ids = get_watch_ids(tokenizer, watch_tokens) if watch_tokens else None
+
+            totals = {}
+            start = time.perf_counter()
+            for lvl, txt, gen, prompts, texts, manifest in pending:
+                metrics = run_configuration(
+                    device,
+                    model,
+                    tokenizer,
+                    results_id,
+                    lvl,
+                    txt,
+                    gen,
+                    prompts,
+                    manifest,
+                    top_k,
+                    max_new_tokens,
+                    batch_size,
+                    capture,
+                    output_format,
+                    prefix_cache,
+                    num_samples,
+                    extra_samples,
+                    max_retries,
+                    texts,
+                    score_source,
+                    watch_ids,
+                    write_buffer * 2**20,
+                    stop_strings,
+                )
+                add_metrics(totals, metrics)
+            print_summary(totals, time.perf_counter() - start, get_peak_rss())
+
+            # free the model before loading the next one
+            del model, tokenizer
+            get_vocab_tokens.cache_clear()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        if validate and precision is not None:
+            validate_precision(
+                device,
+                model_id,
+                precision,
+                configurations,
+                top_k,
+                batch_size,
+                score_source,
+            )
 
 
 if __name__ == "__main__":
@@ -141,28 +2206,36 @@ if __name__ == "__main__":
         "-l",
         "--level",
         type=str,
-        choices=["ce1", "cm1"],
+        nargs="+",
+        choices=LEVELS + ["all"],
         required=True,
-        help="Level of the corpus ('ce1' or 'cm1')",
+        help="Levels of the corpus ('ce1', 'cm1' or 'all' for both levels)",
     )
     parser.add_argument(
         "-t",
         "--text_type",
         type=str,
-        choices=["literature", "scientific"],
+        nargs="+",
+        choices=TEXT_TYPES + ["all"],
         required=True,
-        help="Type of text from the corpus ('literature' or 'scientific')",
+        help="Types of text from the corpus ('literature', 'scientific' or 'all' for both types)",
     )
     parser.add_argument(
         "-g",
         "--gen_type",
         type=str,
-        choices=["continuation", "generation"],
+        nargs="+",
+        choices=GEN_TYPES + ["all"],
         required=True,
-        help="Type of generation ('continuation' or 'generation')",
+        help="Types of generation ('continuation', 'generation' or 'all' for both types)",
     )
     parser.add_argument(
-        "-m", "--model_id", type=str, required=True, help="Model identifier"
+        "-m",
+        "--model_id",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Model identifiers, generated with one after the other",
     )
     parser.add_argument(
         "-k",
@@ -178,6 +2251,108 @@ if __name__ == "__main__":
         default=512,
         help="Maximum number of new tokens to generate (default: 512)",
     )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of prompts of similar length generated together (default: 1)",
+    )
+    parser.add_argument(
+        "-c",
+        "--capture",
+        type=str,
+        choices=["stream", "scores"],
+        default="stream",
+        help="Reduce each step to its top-k during decoding ('stream') or after generation from the full scores ('scores') (default: 'stream')",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        choices=["jsonl", "parquet"],
+        default="jsonl",
+        help="Format of the logits files (default: 'jsonl')",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Regenerate prompts already completed by a previous run",
+    )
+    parser.add_argument(
+        "--no_prefix_cache",
+        action="store_true",
+        help="Encode the whole prompt for every generation instead of reusing the cache of the prefix shared by all prompts",
+    )
+    parser.add_argument(
+        "-n",
+        "--num_samples",
+        type=int,
+        default=1,
+        help="Number of texts generated for each prompt, each saved in its own files (default: 1)",
+    )
+    parser.add_argument(
+        "--extra_samples",
+        type=int,
+        default=0,
+        help="Number of spare texts generated for each prompt to replace texts with no or but few text (default: 0)",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=3,
+        help="Maximum number of times missing texts are generated again (default: 3)",
+    )
+
+    parser.add_argument(
+        "--score",
+        type=str,
+        metavar="SOURCE",
+        default=None,
+        help="Score existing texts in a single forward pass instead of generating: 'corpus' for the corpus texts, or a model identifier for the texts it generated",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch_tokens",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Words whose logprob and rank in the whole vocabulary are recorded at every step, even outside the top-k",
+    )
+    parser.add_argument(
+        "-p",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes generating in parallel on CPU, each on its own cores with its own copy of the model (default: 1)",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default=None,
+        help="Precision of the model weights, 'int8' quantizing its linear layers on CPU; results are saved under <model>_<precision> (default: float16 on GPU, float32 on CPU)",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Score the tokens saved by the default precision run with --precision and in float32, and print the max abs error of their logprobs",
+    )
+
+    parser.add_argument(
+        "--write_buffer",
+        type=int,
+        default=256,
+        help="MiB of generations that may wait to be written while the next batches generate, beyond which generation waits for the disk (default: 256)",
+    )
+
+    parser.add_argument(
+        "--stop_strings",
+        type=str,
+        nargs="*",
+        default=None,
+        help="Strings that end a generated text, cut before them; without any, texts run to max_new_tokens (default: the delimiters of the few-shot prompts)",
+    )
 
     args = parser.parse_args()
 
@@ -187,5 +2362,42 @@ if __name__ == "__main__":
     top_k = args.top_k
     max_new_tokens = args.max_new_tokens
     model_id = args.model_id
+    batch_size = args.batch_size
+    capture = args.capture
+    output_format = args.format
+    resume = not args.no_resume
+    prefix_cache = not args.no_prefix_cache
+    num_samples = args.num_samples
+    extra_samples = args.extra_samples
+    max_retries = args.max_retries
+    score_source = args.score
+    watch_tokens = args.watch_tokens
+    workers = args.workers
+    precision = args.precision
+    validate = args.validate
+    write_buffer = args.write_buffer
+    stop_strings = args.stop_strings
 
-    main(level, text_type, gen_type, model_id, top_k, max_new_tokens)
+    main(
+        level,
+        text_type,
+        gen_type,
+        model_id,
+        top_k,
+        max_new_tokens,
+        batch_size,
+        capture,
+        output_format,
+        resume,
+        prefix_cache,
+        num_samples,
+        extra_samples,
+        max_retries,
+        score_source,
+        watch_tokens,
+        workers,
+        precision,
+        validate,
+        write_buffer,
+        stop_strings,
+    )
@@ -0,0 +1,404 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from atomic import atomic_open
+from store import (
+    get_log_paths,
+    get_top_k_alternatives,
+    get_watched_alternatives,
+    load_log_files,
+    normalize_tokens,
+    parse_logits_path,
+)
+
+INDEX_DIR = ".token_index"
+FILES_TABLE = "files.parquet"
+FILE_COLUMNS = [
+    "file_id",
+    "path",
+    "mtime",
+    "size",
+    "segment",
+    "model",
+    "level",
+    "text_type",
+    "gen_type",
+    "task",
+    "prompt_id",
+    "text",
+]
+# beyond this many segments, the index is rebuilt into a single segment
+MAX_SEGMENTS = 8
+
+
+def get_index_dir(results_dir="results"):
+    return os.path.join(results_dir, INDEX_DIR)
+
+
+def get_segment_path(index_dir, segment, name):
+    return os.path.join(index_dir, f"segment_{segment}_{name}.arrow")
+
+
+def write_arrow(path, table):
+    """Write an uncompressed Arrow file, which can be memory-mapped."""
+    with atomic_open(path, "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_arrow(path):
+    """Memory-map an Arrow file written by write_arrow."""
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def load_files_table(index_dir):
+    """Load the indexed files and the counters of the index."""
+    path = os.path.join(index_dir, FILES_TABLE)
+    if not os.path.exists(path):
+        return pd.DataFrame(), {"next_file_id": 0, "next_segment": 0}
+
+    table = pq.read_table(path)
+    return table.to_pandas(), json.loads(table.schema.metadata[b"counters"])
+
+
+def get_file_states(results_dir):
+    """Return the mtime and size of every logits file of a results tree."""
+    states = {}
+    for path in get_log_paths(os.path.join(results_dir, "*/*/*/*/logits/*")):
+        stat = os.stat(path)
+        states[path] = (stat.st_mtime_ns, stat.st_size)
+    return states
+
+
+def get_stale_paths(files, states):
+    """Return the files new, changed or removed since they were indexed."""
+    indexed = dict(zip(files["path"], zip(files["mtime"], files["size"])))
+    return sorted(
+        path
+        for path in set(states) | set(indexed)
+        if states.get(path) != indexed.get(path)
+    )
+
+
+def write_segment(index_dir, segment, paths, first_file_id, workers=None):
+    """Index logits files into a new segment.
+
+    A segment holds the steps of its files, and the postings of every
+    normalized top-k and watched token sorted by token, so that the postings
+    of a token are a contiguous slice. Returns the rows of its files.
+    """
+    logs = load_log_files(paths, context=True, workers=workers)
+
+    write_arrow(
+        get_segment_path(index_dir, segment, "steps"),
+        pa.table(
+            {
+                "file_id": pa.array(first_file_id + logs["file"], pa.int32()),
+                "step": pa.array(logs["step"], pa.int32()),
+                "token": pa.array(logs["token"], pa.string()),
+                "logprob": pa.array(logs["logprob"], pa.float32()),
+                "offset": pa.array(logs["offset"], pa.int32()),
+            }
+        ),
+    )
+
+    postings = pd.concat(
+        [
+            get_top_k_alternatives(logs, ranked=True).assign(watched=False),
+            get_watched_alternatives(logs).assign(watched=True),
+        ],
+        ignore_index=True,
+    )
+    codes, tokens = pd.factorize(postings["token"], sort=True)
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(tokens))
+
+    write_arrow(
+        get_segment_path(index_dir, segment, "postings"),
+        pa.table(
+            {
+                "row": pa.array(postings["row"].to_numpy()[order], pa.int32()),
+                "rank": pa.array(postings["rank"].to_numpy()[order], pa.int32()),
+                "logprob": pa.array(
+                    postings["logprob"].to_numpy()[order], pa.float32()
+                ),
+                "watched": pa.array(postings["watched"].to_numpy()[order]),
+            }
+        ),
+    )
+    write_arrow(
+        get_segment_path(index_dir, segment, "tokens"),
+        pa.table(
+            {
+                "token": pa.array(tokens, pa.string()),
+                "start": pa.array(np.cumsum(counts) - counts, pa.int64()),
+                "count": pa.array(counts, pa.int64()),
+            }
+        ),
+    )
+
+    texts = logs.groupby("file")["text"].first()
+    files = []
+    for i, path in enumerate(paths):
+        stat = os.stat(path)
+        model, level, text_type, gen_type, prompt_id = parse_logits_path(path)
+        files.append(
+            {
+                "file_id": first_file_id + i,
+                "path": path,
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "segment": segment,
+                "model": model,
+                "level": level,
+                "text_type": text_type,
+                "gen_type": gen_type,
+                "task": os.path.normpath(path).split(os.sep)[-3],
+                "prompt_id": prompt_id,
+                "text": texts.get(i) or "",
+            }
+        )
+
+    return pd.DataFrame(files, columns=FILE_COLUMNS)
+
+
+def build_index(results_dir="results", rebuild=False, workers=None):
+    """Build or update the token index of a results tree.
+
+    Only the logits files that are new or changed since the last build are
+    indexed, into a new segment; the entries of changed and removed files
+    are dropped. The index is rebuilt from scratch with rebuild, or once it
+    has more than MAX_SEGMENTS segments.
+    """
+    index_dir = get_index_dir(results_dir)
+    files, counters = load_files_table(index_dir)
+    states = get_file_states(results_dir)
+    paths = list(states)
+
+    indexed = len(files)
+    if files.empty or rebuild:
+        files = pd.DataFrame(columns=FILE_COLUMNS)
+    else:
+        files = files[
+            [
+                states.get(path) == (mtime, size)
+                for path, mtime, size in zip(
+                    files["path"], files["mtime"], files["size"]
+                )
+            ]
+        ]
+
+    known = set(files["path"])
+    stale = [path for path in paths if path not in known]
+    if not stale and len(files) == indexed:
+        print(f"Token index of {len(files)} files is up to date")
+        return
+
+    if stale and files["segment"].nunique() + 1 > MAX_SEGMENTS:
+        print(f"More than {MAX_SEGMENTS} segments, rebuilding the index")
+        files = pd.DataFrame(columns=FILE_COLUMNS)
+        stale = paths
+
+    os.makedirs(index_dir, exist_ok=True)
+    if stale:
+        print(f"Indexing {len(stale)} files")
+        segment = counters["next_segment"]
+        new_files = write_segment(
+            index_dir, segment, stale, counters["next_file_id"], workers
+        )
+        files = (
+            new_files
+            if files.empty
+            else pd.concat([files, new_files], ignore_index=True)
+        )
+        counters = {
+            "next_file_id": counters["next_file_id"] + len(stale),
+            "next_segment": segment + 1,
+        }
+
+    table = pa.Table.from_pandas(files, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"counters": json.dumps(counters).encode()}
+    )
+    path = os.path.join(index_dir, FILES_TABLE)
+    with atomic_open(path, "wb") as f:
+        pq.write_table(table, f)
+
+    # segments whose files were all dropped are no longer needed
+    segments = set(files["segment"])
+    for filename in os.listdir(index_dir):
+        if filename.startswith("segment_"):
+            if int(filename.split("_")[1]) not in segments:
+                os.remove(os.path.join(index_dir, filename))
+
+    print(f"Token index of {len(files)} files in {len(segments)} segments")
+
+
+class TokenIndex:
+    """Inverted index from normalized tokens to the steps they appear at.
+
+    Segments are memory-mapped when first queried; only the postings of the
+    queried tokens and the steps they point to are read. A warning is
+    printed when logits files were added, changed or removed since the
+    index was built, as their steps would be missing or out of date.
+    """
+
+    def __init__(self, results_dir="results"):
+        self.index_dir = get_index_dir(results_dir)
+        self.files, _ = load_files_table(self.index_dir)
+        if self.files.empty:
+            raise ValueError(f"No token index in {results_dir}, build it first")
+        self.segments = {}
+
+        self.stale = get_stale_paths(self.files, get_file_states(results_dir))
+        if self.stale:
+            print(
+                f"Warning: {len(self.stale)} logits files were added, changed or "
+                f"removed since the token index of {results_dir} was built, "
+                "run python index.py to update it"
+            )
+
+    def open_segment(self, segment):
+        if segment not in self.segments:
+            tokens = read_arrow(get_segment_path(self.index_dir, segment, "tokens"))
+            self.segments[segment] = (
+                read_arrow(get_segment_path(self.index_dir, segment, "steps")),
+                read_arrow(get_segment_path(self.index_dir, segment, "postings")),
+                dict(
+                    zip(
+                        tokens.column("token").to_pylist(),
+                        zip(
+                            tokens.column("start").to_pylist(),
+                            tokens.column("count").to_pylist(),
+                        ),
+                    )
+                ),
+            )
+
+        return self.segments[segment]
+
+    def get_postings(self, tokens, file_ids=None):
+        """Return the postings of tokens in the indexed files (or file_ids).
+
+        Each posting holds the segment and row of its step, the file_id and
+        step, the chosen token, logprob and offset of the step, and the
+        token, logprob, rank and watched flag of the alternative.
+        """
+        files = self.files
+        if file_ids is not None:
+            files = files[files["file_id"].isin(file_ids)]
+
+        postings = []
+        for segment in files["segment"].unique():
+            steps, segment_postings, token_slices = self.open_segment(segment)
+            for token in tokens:
+                if token not in token_slices:
+                    continue
+                start, count = token_slices[token]
+                found = segment_postings.slice(start, count).to_pandas()
+                rows = pa.array(found["row"])
+                found["segment"] = segment
+                found["token"] = token
+                found["file_id"] = steps.column("file_id").take(rows).to_numpy()
+                found["step"] = steps.column("step").take(rows).to_numpy()
+                found["chosen_token"] = steps.column("token").take(rows).to_pylist()
+                found["chosen_logprob"] = steps.column("logprob").take(rows).to_numpy()
+                found["offset"] = steps.column("offset").take(rows).to_numpy()
+                postings.append(found[found["file_id"].isin(files["file_id"])])
+
+        if not postings:
+            return pd.DataFrame(
+                columns=[
+                    "row",
+                    "rank",
+                    "logprob",
+                    "watched",
+                    "segment",
+                    "token",
+                    "file_id",
+                    "step",
+                    "chosen_token",
+                    "chosen_logprob",
+                    "offset",
+                ]
+            )
+        return pd.concat(postings, ignore_index=True)
+
+    def query(self, token, **fields):
+        """Return where a token appears among the top-k or watched tokens.
+
+        token is normalized like the tokens of the index, and fields filter
+        the files on their model, level, text_type, gen_type, task or
+        prompt_id, each taking a value or a list of values.
+        """
+        files = self.files
+        for name, value in fields.items():
+            values = [value] if isinstance(value, str) else list(value)
+            files = files[files[name].isin(values)]
+
+        token = normalize_tokens([token])[0]
+        postings = self.get_postings([token], files["file_id"])
+        postings = postings.merge(
+            files[["file_id", "model", "level", "text_type", "gen_type", "prompt_id"]],
+            on="file_id",
+        )
+
+        return postings[
+            [
+                "model",
+                "level",
+                "text_type",
+                "gen_type",
+                "prompt_id",
+                "step",
+                "rank",
+                "logprob",
+                "watched",
+            ]
+        ].sort_values(["model", "level", "text_type", "gen_type", "prompt_id", "step"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the token index of the logits files, or query it"
+    )
+    parser.add_argument(
+        "-r",
+        "--results_dir",
+        type=str,
+        default="results",
+        help="Results folder to index (default: 'results')",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Index every logits file again instead of only new or changed ones",
+    )
+    parser.add_argument(
+        "-p",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the logits files in parallel (default: one per core)",
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        type=str,
+        default=None,
+        help="Token to look up in the index instead of building it",
+    )
+
+    args = parser.parse_args()
+
+    if args.query is None:
+        build_index(args.results_dir, args.rebuild, args.workers)
+    else:
+        found = TokenIndex(args.results_dir).query(args.query)
+        print(found.to_string(index=False))
+        print(f"{len(found)} steps with {args.query!r} among their alternatives")
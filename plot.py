@@ -1,15 +1,34 @@
 import argparse
-import glob
+import fnmatch
+import functools
+import hashlib
 import json
 import math
 import os
+import sys
 import textwrap
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.parquet as pq
 from plotly.subplots import make_subplots
+from atomic import atomic_open
+from index import TokenIndex, build_index
+from store import (
+    get_log_paths,
+    get_top_k_alternatives,
+    get_watched_alternatives,
+    load_log_files,
+    normalize_tokens,
+    parse_logits_path,
+)
 
 LANG = "fr"
+PAIR_CACHE_DIR = os.path.join("results", ".pair_cache")
+SURPRISAL_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
 T = {
     "fr": {
         "lquote": "« ",
@@ -42,15 +61,10 @@ T = {
 }
 
 
-def load_log_files(folder):
-    records = []
-    for filename in glob.glob(folder):
-        # print(filename)
-        if filename.endswith(".jsonl"):
-            with open(filename, encoding="utf8") as f:
-                for line in f:
-                    records.append(json.loads(line.strip()))
-    return records
+def get_recent_context(text, offset, context_window):
+    """Return the last context_window words preceding the token at offset."""
+    context = text[:offset] if text else ""
+    return " ".join(context.split()[-context_window:]) if context else ""
 
 
 def logprob_to_prob(logprob):
@@ -61,51 +75,266 @@ def prob_to_surprisal(prob):
     return -math.log2(prob) if prob > 0 else float("inf")
 
 
-def extract_pair_data(records, token_pairs, top_k_limit=None, context_window=20):
-    data = []
-    for record in records:
-        step = record["step"]
-        chosen_token = record["token"].strip("Ġ▁")
-        top_k = {tk["token"].strip("Ġ▁"): tk["logprob"] for tk in record["top_k"]}
+def extract_pair_data(logs, token_pairs, top_k_limit=None, context_window=20):
+    """Extract the steps where a token of a pair is among the alternatives.
 
-        # limit top_k to top_k_limit
-        if top_k_limit is not None:
-            top_k = dict(
-                sorted(top_k.items(), key=lambda item: item[1], reverse=True)[
-                    :top_k_limit
-                ]
+    token_pairs is a list of {key: value} dicts, all extracted in a single
+    pass over the columns of load_log_files. Returns a row per step and pair
+    whose key or value is in the top-k (within top_k_limit) or watched, with
+    the logprobs of both tokens and, when one of them is the chosen token,
+    its probability and surprisal.
+    """
+    pair_tokens = get_pair_tokens(token_pairs)
+    top_k = get_top_k_alternatives(logs, pair_tokens, ranked=top_k_limit is not None)
+    watch = get_watched_alternatives(logs, pair_tokens)
+
+    return build_pair_rows(logs, top_k, watch, token_pairs, top_k_limit, context_window)
+
+
+def get_pair_tokens(token_pairs):
+    """Return the set of the tokens of a list of {key: value} pairs."""
+    return {token for pair in token_pairs for item in pair.items() for token in item}
+
+
+def build_pair_rows(
+    steps, top_k, watch, token_pairs, top_k_limit=None, context_window=20
+):
+    """Build the pair data from the alternatives of the pair tokens.
+
+    steps holds the file, step, token and logprob (and text and offset for
+    the context) of the steps that top_k and watch refer to by row, as
+    returned by get_top_k_alternatives and get_watched_alternatives.
+
+    The logprobs of the two distributions are kept apart: key_logprob,
+    value_logprob and chosen_logprob (and so chosen_prob and surprisal) come
+    from the sampling distribution, after the warpers, as in the top-k;
+    key_watch_logprob and value_watch_logprob come from the model
+    distribution before the warpers, as watched.
+    """
+    pairs = pd.DataFrame(
+        [(key, value) for pair in token_pairs for key, value in pair.items()],
+        columns=["pair_key", "pair_value"],
+    )
+    pairs["pair"] = np.arange(len(pairs))
+
+    if top_k_limit is not None:
+        top_k = top_k[top_k["rank"] < top_k_limit]
+        watch = watch[watch["rank"] < top_k_limit]
+    # watched tokens have their exact logprob at every step, even outside
+    # the top-k; their variants (leading space, ...) share a token
+    watch = watch.groupby(["row", "token"], as_index=False)["logprob"].max()
+    top_k = top_k[["row", "token", "logprob"]].drop_duplicates(["row", "token"])
+
+    data = None
+    for candidates, suffix in [(top_k, "logprob"), (watch, "watch_logprob")]:
+        for side in ["key", "value"]:
+            matches = candidates.merge(pairs, left_on="token", right_on=f"pair_{side}")
+            matches = matches[["row", "pair", "logprob"]].rename(
+                columns={"logprob": f"{side}_{suffix}"}
+            )
+            data = (
+                matches
+                if data is None
+                else data.merge(matches, on=["row", "pair"], how="outer")
             )
+    data = data.merge(pairs, on="pair").sort_values(["row", "pair"], ignore_index=True)
+
+    rows = data["row"].to_numpy()
+    chosen_token = normalize_tokens(steps["token"].to_numpy()[rows])
+    chosen_logprob = steps["logprob"].to_numpy(dtype=float)[rows]
+
+    # extract context (preceding tokens) only for steps that are kept
+    recent_context = None
+    if "text" in steps.columns:
+        texts = steps["text"].to_numpy()
+        offsets = steps["offset"].to_numpy()
+        contexts = {
+            row: get_recent_context(texts[row], offsets[row], context_window)
+            for row in np.unique(rows)
+        }
+        recent_context = [contexts[row] for row in rows]
+
+    is_key = chosen_token == data["pair_key"].to_numpy()
+    is_value = chosen_token == data["pair_value"].to_numpy()
+    chosen_type = np.select([is_key, is_value], ["key", "value"], None)
+    chosen_prob = np.where(is_key | is_value, np.exp(chosen_logprob), np.nan)
+    with np.errstate(divide="ignore"):
+        surprisal = np.where(chosen_prob > 0, -np.log2(chosen_prob), np.inf)
+    surprisal[np.isnan(chosen_prob)] = np.nan
+
+    return pd.DataFrame(
+        {
+            "file": steps["file"].to_numpy()[rows],
+            "step": steps["step"].to_numpy()[rows],
+            "pair_key": data["pair_key"],
+            "pair_value": data["pair_value"],
+            "chosen_token": chosen_token,
+            "key_logprob": data["key_logprob"],
+            "value_logprob": data["value_logprob"],
+            "key_watch_logprob": data["key_watch_logprob"],
+            "value_watch_logprob": data["value_watch_logprob"],
+            "chosen_logprob": chosen_logprob,
+            "recent_context": recent_context,
+            "chosen_type": chosen_type,
+            "chosen_prob": chosen_prob,
+            "surprisal": surprisal,
+        }
+    )
+
+
+def load_pair_data(
+    folder,
+    token_pairs,
+    top_k_limit=None,
+    context_window=20,
+    workers=None,
+    cache_dir=PAIR_CACHE_DIR,
+):
+    """Extract the pair data of the logits files matching a glob pattern.
+
+    The pair data of each file is cached on disk, in a Parquet file per set
+    of extraction parameters, along with the mtime and size of the file it
+    comes from. Only files that are new or changed since they were cached
+    are read and extracted; the others are read back from the cache. With
+    cache_dir None, every file is extracted.
+    """
+    paths = get_log_paths(folder)
+    if cache_dir is None:
+        return extract_pair_data(
+            load_log_files(paths, context=True, workers=workers),
+            token_pairs,
+            top_k_limit,
+            context_window,
+        )
+
+    params = json.dumps(
+        {
+            "token_pairs": token_pairs,
+            "top_k_limit": top_k_limit,
+            "context_window": context_window,
+        },
+        sort_keys=True,
+    )
+    cache_path = os.path.join(
+        cache_dir, f"pairs_{hashlib.sha256(params.encode()).hexdigest()[:16]}.parquet"
+    )
+
+    states = {}
+    for path in paths:
+        stat = os.stat(path)
+        states[path] = [stat.st_mtime_ns, stat.st_size]
+
+    cached = pd.DataFrame()
+    sources = {}
+    if os.path.exists(cache_path):
+        table = pq.read_table(cache_path)
+        # caches written before the watched logprobs had columns of their
+        # own are extracted again
+        if "key_watch_logprob" in table.column_names:
+            sources = json.loads(table.schema.metadata[b"sources"])
+            cached = table.to_pandas()
+    stale = [path for path in paths if sources.get(path) != states[path]]
+
+    if stale:
+        print(f"Extracting pair data from {len(stale)}/{len(paths)} files")
+        logs = load_log_files(stale, context=True, workers=workers)
+        new = extract_pair_data(logs, token_pairs, top_k_limit, context_window)
+        new["source"] = np.array(stale, dtype=object)[new["file"].to_numpy()]
+
+        # files cached for other patterns are kept as they are
+        if not cached.empty:
+            cached = cached[~cached["source"].isin(stale)]
+        cached = pd.concat([cached, new], ignore_index=True)
+        sources.update({path: states[path] for path in stale})
+
+        table = pa.Table.from_pandas(cached, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {
+                **table.schema.metadata,
+                b"params": params.encode(),
+                b"sources": json.dumps(sources).encode(),
+            }
+        )
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_open(cache_path, "wb") as f:
+            pq.write_table(table, f, compression="zstd")
+
+    if cached.empty:
+        return extract_pair_data(load_log_files([]), token_pairs)
+
+    # rows of the matching files, in the order they would be extracted in
+    file_ids = {path: i for i, path in enumerate(paths)}
+    df = cached[cached["source"].isin(file_ids)].copy()
+    df["file"] = df["source"].map(file_ids)
+    df = df.sort_values("file", kind="stable", ignore_index=True)
+    df = df.drop(columns="source")
+    df.attrs["files"] = paths
+    return df
+
+
+def load_index_pair_data(
+    index, folder, token_pairs, top_k_limit=None, context_window=20
+):
+    """Extract the pair data of the files matching a glob pattern from a TokenIndex.
+
+    Only the postings of the pair tokens and the steps they point to are
+    read, never the logits files; the result is the same as
+    extract_pair_data on these files when the index is up to date.
+    """
+    files = index.files[
+        [fnmatch.fnmatchcase(path, folder) for path in index.files["path"]]
+    ].sort_values("path", ignore_index=True)
+    postings = index.get_postings(get_pair_tokens(token_pairs), files["file_id"])
+
+    # one row per distinct step, in the order of its file and step
+    file_ids = {file_id: i for i, file_id in enumerate(files["file_id"])}
+    postings["file"] = postings["file_id"].map(file_ids)
+    steps = postings.drop_duplicates(["segment", "row"]).sort_values(
+        ["file", "step"], ignore_index=True
+    )
+    step_rows = pd.Series(
+        np.arange(len(steps)),
+        index=pd.MultiIndex.from_frame(steps[["segment", "row"]]),
+    )
+    postings["row"] = step_rows.reindex(
+        pd.MultiIndex.from_frame(postings[["segment", "row"]])
+    ).to_numpy()
+    steps = pd.DataFrame(
+        {
+            "file": steps["file"],
+            "step": steps["step"],
+            "token": steps["chosen_token"],
+            "logprob": steps["chosen_logprob"].astype(float),
+            "text": files["text"].to_numpy()[steps["file"].to_numpy(dtype=int)],
+            "offset": steps["offset"],
+        }
+    )
+
+    columns = ["row", "token", "logprob", "rank"]
+    postings["logprob"] = postings["logprob"].astype(float)
+    df = build_pair_rows(
+        steps,
+        postings.loc[~postings["watched"], columns],
+        postings.loc[postings["watched"], columns],
+        token_pairs,
+        top_k_limit,
+        context_window,
+    )
+    df.attrs["files"] = list(files["path"])
+    return df
 
-        # extract context (preceding tokens)
-        context = record.get("context", "")
-        recent_context = " ".join(context.split()[-context_window:]) if context else ""
-
-        for pair in token_pairs:
-            for key, value in pair.items():
-                has_key = key in top_k
-                has_value = value in top_k
-
-                if has_key or has_value:
-                    entry = {
-                        "step": step,
-                        "pair_key": key,
-                        "pair_value": value,
-                        "chosen_token": chosen_token,
-                        "key_logprob": top_k.get(key, None),
-                        "value_logprob": top_k.get(value, None),
-                        "chosen_logprob": record["logprob"],
-                        "recent_context": recent_context,
-                    }
-
-                    if chosen_token in [key, value]:
-                        entry["chosen_type"] = "key" if chosen_token == key else "value"
-                        entry["chosen_prob"] = logprob_to_prob(record["logprob"])
-                        entry["surprisal"] = prob_to_surprisal(entry["chosen_prob"])
-                    else:
-                        entry["chosen_type"] = None
-
-                    data.append(entry)
-    return pd.DataFrame(data)
+
+def get_pair_logprobs(df):
+    """Return the key and value logprobs of each row, from one distribution.
+
+    The watched logprobs, from before the warpers, are only used when both
+    tokens of the pair are watched; otherwise both come from the top-k,
+    after the warpers, so that a ratio never mixes the two.
+    """
+    watched = df["key_watch_logprob"].notna() & df["value_watch_logprob"].notna()
+    key_logprob = df["key_watch_logprob"].where(watched, df["key_logprob"])
+    value_logprob = df["value_watch_logprob"].where(watched, df["value_logprob"])
+    return key_logprob.astype(float), value_logprob.astype(float)
 
 
 def calculate_confidence_metrics(df):
@@ -114,63 +343,202 @@ def calculate_confidence_metrics(df):
         return df
 
     df_with_probs = df.copy()
+    key_logprob, value_logprob = get_pair_logprobs(df_with_probs)
 
     # calculate probabilities if not already present
     if "key_prob" not in df_with_probs.columns:
-        df_with_probs["key_prob"] = df_with_probs["key_logprob"].apply(
-            lambda x: logprob_to_prob(x) if pd.notna(x) else 0
-        )
+        df_with_probs["key_prob"] = np.exp(key_logprob).fillna(0)
 
     if "value_prob" not in df_with_probs.columns:
-        df_with_probs["value_prob"] = df_with_probs["value_logprob"].apply(
-            lambda x: logprob_to_prob(x) if pd.notna(x) else 0
-        )
+        df_with_probs["value_prob"] = np.exp(value_logprob).fillna(0)
 
-    # confidence as normalized probability
-    def calculate_confidence(row):
-        if pd.isna(row["chosen_type"]):
-            return None
+    is_chosen = df_with_probs["chosen_type"].isin(["key", "value"]).to_numpy()
+    is_key = (df_with_probs["chosen_type"] == "key").to_numpy()
+    key_prob = df_with_probs["key_prob"].to_numpy()
+    value_prob = df_with_probs["value_prob"].to_numpy()
+    selected_prob = np.where(is_key, key_prob, value_prob)
+    alt_prob = np.where(is_key, value_prob, key_prob)
 
-        total_prob = row["key_prob"] + row["value_prob"]
-        if total_prob <= 0:
-            return 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # confidence as normalized probability
+        total_prob = key_prob + value_prob
+        confidence = np.where(total_prob > 0, selected_prob / total_prob, 0.0)
+        # ratio of chosen to alternative
+        ratio_score = np.where(alt_prob > 0, selected_prob / alt_prob, np.inf)
 
-        if row["chosen_type"] == "key":
-            return row["key_prob"] / total_prob
-        else:  # "value"
-            return row["value_prob"] / total_prob
+    df_with_probs["confidence"] = np.where(is_chosen, confidence, np.nan)
+    df_with_probs["ratio_score"] = np.where(is_chosen, ratio_score, np.nan)
 
-    df_with_probs["confidence"] = df_with_probs.apply(calculate_confidence, axis=1)
+    return df_with_probs
 
-    # ratio of chosen to alternative
-    def calculate_ratio_score(row):
-        if pd.isna(row["chosen_type"]):
-            return None
 
-        if row["chosen_type"] == "key":
-            alt_prob = row["value_prob"]
-            chosen_prob = row["key_prob"]
-        else:  # "value"
-            alt_prob = row["key_prob"]
-            chosen_prob = row["value_prob"]
+def select_ratio_points(df, min_ratio):
+    """Keep the rows of a model that are drawn by the plots.
 
-        if alt_prob <= 0:
-            return float("inf")
-        return chosen_prob / alt_prob
+    These are the rows where both tokens of the pair have a logprob, one of
+    them is chosen, and the other is at least min_ratio times as probable.
+    Computed once per model with calculate_confidence_metrics, the result
+    is shared by every plot.
+    """
+    if df.empty:
+        print("Empty dataframe, nothing to plot")
+        return df
 
-    df_with_probs["ratio_score"] = df_with_probs.apply(calculate_ratio_score, axis=1)
+    df = calculate_confidence_metrics(df)
+
+    key_logprob, value_logprob = get_pair_logprobs(df)
+    filtered = df[
+        key_logprob.notna()
+        & value_logprob.notna()
+        & df["chosen_type"].isin(["key", "value"])
+    ]
+    if filtered.empty:
+        print("No valid data points after filtering")
+        return filtered
+
+    is_key = filtered["chosen_type"] == "key"
+    selected_prob = filtered["key_prob"].where(is_key, filtered["value_prob"])
+    alt_prob = filtered["value_prob"].where(is_key, filtered["key_prob"])
+    filtered = filtered[alt_prob >= min_ratio * selected_prob].copy()
+    if filtered.empty:
+        print("No data points meet the minimum ratio requirement")
+
+    return filtered
+
+
+def read_pairs(path):
+    """Read a file of token pairs, one "key value" pair per line.
+
+    Blank lines and lines starting with # are skipped.
+    """
+    token_pairs = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, value = line.split()
+            token_pairs.append({key: value})
+    return token_pairs
+
+
+def summarize_pairs(df, min_ratio):
+    """Aggregate the pair data of files by model, configuration and pair.
+
+    For each model, level, text_type, gen_type and pair, counts the steps
+    where a token of the pair is an alternative, those where the key or the
+    value is chosen and those where both have a logprob, and gives the mean
+    confidence of the steps with both logprobs, the surprisal quantiles of
+    the chosen tokens, and the share of the steps with both logprobs that
+    meet min_ratio.
+    """
+    groups = ["model", "level", "text_type", "gen_type", "pair_key", "pair_value"]
+    columns = groups + ["steps", "chosen_key", "chosen_value", "both_logprobs"]
+    columns += ["mean_confidence"]
+    columns += [f"surprisal_q{round(q * 100)}" for q in SURPRISAL_QUANTILES]
+    columns += ["ratio_share"]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
 
-    return df_with_probs
+    df = calculate_confidence_metrics(df)
+    files = pd.DataFrame(
+        [parse_logits_path(path) for path in df.attrs["files"]],
+        columns=["model", "level", "text_type", "gen_type", "prompt_id"],
+    )
+    for name in groups[:4]:
+        df[name] = files[name].to_numpy()[df["file"].to_numpy(dtype=int)]
+
+    is_key = df["chosen_type"] == "key"
+    key_logprob, value_logprob = get_pair_logprobs(df)
+    both = (
+        key_logprob.notna()
+        & value_logprob.notna()
+        & df["chosen_type"].isin(["key", "value"])
+    )
+    selected_prob = df["key_prob"].where(is_key, df["value_prob"])
+    alt_prob = df["value_prob"].where(is_key, df["key_prob"])
+    df["chosen_key"] = is_key
+    df["chosen_value"] = df["chosen_type"] == "value"
+    df["both_logprobs"] = both
+    df["meets_ratio"] = both & (alt_prob >= min_ratio * selected_prob)
+    # with a single logprob, the confidence of a step is 0 or 1
+    df["both_confidence"] = df["confidence"].where(both)
+
+    grouped = df.groupby(groups)
+    summary = grouped.agg(
+        steps=("step", "size"),
+        chosen_key=("chosen_key", "sum"),
+        chosen_value=("chosen_value", "sum"),
+        both_logprobs=("both_logprobs", "sum"),
+        meets_ratio=("meets_ratio", "sum"),
+        mean_confidence=("both_confidence", "mean"),
+    )
+    quantiles = grouped["surprisal"].quantile(SURPRISAL_QUANTILES).unstack()
+    quantiles.columns = [f"surprisal_q{round(q * 100)}" for q in quantiles.columns]
+    summary = summary.join(quantiles)
+    summary["ratio_share"] = summary["meets_ratio"] / summary["both_logprobs"]
+
+    return summary.reset_index()[columns]
+
+
+def summarize_model(
+    folder,
+    token_pairs,
+    min_ratio,
+    top_k_limit=None,
+    use_index=False,
+):
+    """Extract every pair from the files of a model and summarize them."""
+    if use_index:
+        df = load_index_pair_data(TokenIndex(), folder, token_pairs, top_k_limit)
+    else:
+        logs = load_log_files(folder, workers=1)
+        df = extract_pair_data(logs, token_pairs, top_k_limit)
+        df.attrs["files"] = logs.attrs["files"]
+
+    return summarize_pairs(df, min_ratio)
+
+
+def summarize_models(
+    folders,
+    token_pairs,
+    min_ratio,
+    top_k_limit=None,
+    use_index=False,
+    workers=None,
+):
+    """Summarize every pair for several models, one process per model.
+
+    folders are the glob patterns of the logits files of each model. Each
+    model is read once for all pairs, without the contexts of the steps.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    summarize = functools.partial(
+        summarize_model,
+        token_pairs=token_pairs,
+        min_ratio=min_ratio,
+        top_k_limit=top_k_limit,
+        use_index=use_index,
+    )
+
+    if workers > 1 and len(folders) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(folders))) as executor:
+            summaries = list(executor.map(summarize, folders))
+    else:
+        summaries = [summarize(folder) for folder in folders]
+
+    return pd.concat(summaries, ignore_index=True)
 
 
 def plot_surprisal_context(
     dfs,
-    min_ratio,
     models,
     surprisal_threshold=4,
     save_to_file=False,
     save_interactive=False,
 ):
+    """Plot the surprisal of the chosen pair tokens, dfs from select_ratio_points."""
     model_titles = {
         "llama": "Llama-3.2-3B",
         "mistral": "Mistral-7B-Instruct-v0.3",
@@ -183,38 +551,13 @@ def plot_surprisal_context(
         subplot_titles=[f"<b>{model_titles[model]}</b>" for model in models],
     )
 
-    for idx, df in enumerate(dfs):
-        if df.empty:
-            print("Empty dataframe, nothing to plot")
+    for idx, filtered in enumerate(dfs):
+        if filtered.empty:
             return
 
-        df = calculate_confidence_metrics(df)
-
         row = 1
         col = idx + 1
 
-        filtered = df[
-            df["key_logprob"].notna()
-            & df["value_logprob"].notna()
-            & df["chosen_type"].isin(["key", "value"])
-        ].copy()
-
-        if filtered.empty:
-            print("No valid data points after filtering")
-            return
-
-        def meets_ratio(row):
-            if row["chosen_type"] == "key":
-                return row["value_prob"] >= min_ratio * row["key_prob"]
-            elif row["chosen_type"] == "value":
-                return row["key_prob"] >= min_ratio * row["value_prob"]
-            return False
-
-        filtered = filtered[filtered.apply(meets_ratio, axis=1)]
-        if filtered.empty:
-            print("No data points meet the minimum ratio requirement")
-            return
-
         key_token = filtered["pair_key"].iloc[0]
         value_token = filtered["pair_value"].iloc[0]
 
@@ -346,6 +689,7 @@ def plot_pair_probabilities(
     top_k_limit=None,
     save_to_file=False,
 ):
+    """Plot the probabilities of the pair tokens, dfs from select_ratio_points."""
     model_titles = {
         "llama": "Llama-3.2-3B",
         "mistral": "Mistral-7B-Instruct-v0.3",
@@ -358,40 +702,13 @@ def plot_pair_probabilities(
         subplot_titles=[f"<b>{model_titles[model]}</b>" for model in models],
     )
 
-    for idx, df in enumerate(dfs):
-        if df.empty:
-            print("Empty dataframe, nothing to plot")
+    for idx, filtered in enumerate(dfs):
+        if filtered.empty:
             return
 
-        df = calculate_confidence_metrics(df)
-
         row = 1
         col = idx + 1
 
-        filtered = df[
-            df["key_logprob"].notna()
-            & df["value_logprob"].notna()
-            & df["chosen_type"].isin(["key", "value"])
-        ].copy()
-
-        # filtered.to_csv(f"{idx}.csv")
-
-        if filtered.empty:
-            print("No valid data points after filtering")
-            return
-
-        def meets_ratio(row):
-            if row["chosen_type"] == "key":
-                return row["value_prob"] >= min_ratio * row["key_prob"]
-            elif row["chosen_type"] == "value":
-                return row["key_prob"] >= min_ratio * row["value_prob"]
-            return False
-
-        filtered = filtered[filtered.apply(meets_ratio, axis=1)]
-        if filtered.empty:
-            print("No data points meet the minimum ratio requirement")
-            return
-
         key_token = filtered["pair_key"].iloc[0]
         value_token = filtered["pair_value"].iloc[0]
 
@@ -529,11 +846,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "token1",
         type=str,
+        nargs="?",
         help="First token to analyze",
     )
     parser.add_argument(
         "token2",
         type=str,
+        nargs="?",
         help="Second token to analyze",
     )
     parser.add_argument(
@@ -563,6 +882,12 @@ if __name__ == "__main__":
         required=True,
         help="Type of generation ('continuation', 'generation', or 'all' for both types)",
     )
+    parser.add_argument(
+        "--source",
+        type=str,
+        default=None,
+        help="Plot the scores of the texts of a source ('corpus' or a model) instead of the generated texts (default: None)",
+    )
     parser.add_argument(
         "-r",
         "--min_ratio",
@@ -610,7 +935,39 @@ if __name__ == "__main__":
         action="store_true",
         help="(surprisal) Save an interactive HTML plot",
     )
+    parser.add_argument(
+        "-p",
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the logits files in parallel (default: one per core)",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Extract the pair data of every logits file instead of reusing the pair data cached for unchanged files",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Read the pair data from the token index built by index.py, updated first, instead of the logits files",
+    )
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        default=None,
+        help="File of token pairs, one 'key value' pair per line, summarized in a single pass instead of plotting token1 and token2",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default="plots/summary.csv",
+        help="(pairs) Summary table, written as Parquet if it ends with .parquet and as CSV otherwise (default: 'plots/summary.csv')",
+    )
     args = parser.parse_args()
+    if args.pairs is None and args.token2 is None:
+        parser.error("token1 and token2 are required unless --pairs is given")
 
     list_dfs = []
 
@@ -632,27 +989,71 @@ if __name__ == "__main__":
 
     if task_plot == "all":
         task_plot = "*"
+    if args.source is None:
+        task_plot = f"{task_plot}_task"
+    else:
+        # texts scored by generate.py --score
+        task_plot = f"{task_plot}_score_{os.path.basename(args.source.rstrip('/'))}"
 
     if args.text_type == "all":
         text_type_plot = "*"
 
     LANG = args.lang
 
-    for k, v in model_map.items():
-        log_folder = (
-            f"results/{v}/{level_plot}/{text_type_plot}/{task_plot}/logits/*.jsonl"
+    if args.index:
+        # only the files new or changed since the last build are indexed
+        build_index(workers=args.workers)
+
+    if args.pairs is not None:
+        summary = summarize_models(
+            [
+                f"results/{v}/{level_plot}/{text_type_plot}/{task_plot}/logits/*"
+                for v in model_map.values()
+            ],
+            read_pairs(args.pairs),
+            args.min_ratio,
+            top_k_limit=args.top_k_limit,
+            use_index=args.index,
+            workers=args.workers,
         )
-        records = load_log_files(log_folder)
-        df = extract_pair_data(
-            records,
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        if args.output.endswith(".parquet"):
+            summary.to_parquet(args.output, index=False)
+        else:
+            summary.to_csv(args.output, index=False)
+        print(f"Summary of {len(summary)} rows saved to {args.output}")
+        sys.exit()
+
+    index = TokenIndex() if args.index else None
+
+    for k, v in model_map.items():
+        log_folder = f"results/{v}/{level_plot}/{text_type_plot}/{task_plot}/logits/*"
+        if index is not None:
+            list_dfs.append(
+                load_index_pair_data(
+                    index,
+                    log_folder,
+                    token_pairs,
+                    top_k_limit=args.top_k_limit,
+                    context_window=args.context_window,
+                )
+            )
+            continue
+        df = load_pair_data(
+            log_folder,
             token_pairs,
             top_k_limit=args.top_k_limit,
             context_window=args.context_window,
+            workers=args.workers,
+            cache_dir=None if args.no_cache else PAIR_CACHE_DIR,
         )
         list_dfs.append(df)
 
+    # metrics and ratio filtering are computed once per model for all plots
+    list_points = [select_ratio_points(df, args.min_ratio) for df in list_dfs]
+
     plot_pair_probabilities(
-        list_dfs,
+        list_points,
         models=args.models,
         min_ratio=args.min_ratio,
         top_k_limit=args.top_k_limit,
@@ -660,9 +1061,8 @@ if __name__ == "__main__":
     )
 
     plot_surprisal_context(
-        list_dfs,
+        list_points,
         models=args.models,
-        min_ratio=args.min_ratio,
         surprisal_threshold=args.surprisal_threshold,
         save_to_file=args.save_svg,
         save_interactive=args.save_html,
@@ -0,0 +1,580 @@
+import argparse
+import contextlib
+import fcntl
+import functools
+import glob
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from atomic import atomic_open
+
+VOCAB_FILE = "vocab.parquet"
+
+LOGITS_SCHEMA = pa.schema(
+    [
+        ("model", pa.dictionary(pa.int32(), pa.string())),
+        ("level", pa.dictionary(pa.int32(), pa.string())),
+        ("text_type", pa.dictionary(pa.int32(), pa.string())),
+        ("gen_type", pa.dictionary(pa.int32(), pa.string())),
+        ("prompt_id", pa.dictionary(pa.int32(), pa.string())),
+        ("step", pa.int32()),
+        ("token_id", pa.int32()),
+        ("logprob", pa.float32()),
+        ("rank", pa.int32()),
+        ("offset", pa.int32()),
+        ("top_k_ids", pa.list_(pa.int32())),
+        ("top_k_logprobs", pa.list_(pa.float32())),
+        # watched tokens, null when no token was watched
+        ("watch_ids", pa.list_(pa.int32())),
+        ("watch_logprobs", pa.list_(pa.float32())),
+        ("watch_ranks", pa.list_(pa.int32())),
+    ]
+)
+
+# per-step columns read from the logits files
+LOG_COLUMNS = [
+    "step",
+    "token",
+    "logprob",
+    "rank",
+    "top_k_tokens",
+    "top_k_logprobs",
+    "watch_tokens",
+    "watch_logprobs",
+    "watch_ranks",
+]
+
+# vocabularies already loaded, by model directory
+_vocabs = {}
+
+
+def get_vocab_path(model_dir):
+    return os.path.join(model_dir, VOCAB_FILE)
+
+
+def load_vocab(model_dir, size=0):
+    """Load the token strings of a model, indexed by their store id.
+
+    The vocabulary is read again from disk when the cached one holds fewer
+    than size tokens, as other processes may have added some since.
+    """
+    if model_dir not in _vocabs or len(_vocabs[model_dir][0]) < size:
+        path = get_vocab_path(model_dir)
+        tokens = []
+        if os.path.exists(path):
+            tokens = pq.read_table(path).column("token").to_pylist()
+        _vocabs[model_dir] = (tokens, {tok: i for i, tok in enumerate(tokens)})
+
+    return _vocabs[model_dir][0]
+
+
+@contextlib.contextmanager
+def lock_vocab(model_dir):
+    """Hold an exclusive lock on the vocabulary table of a model."""
+    os.makedirs(model_dir, exist_ok=True)
+    with open(get_vocab_path(model_dir) + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def encode_tokens(model_dir, tokens):
+    """Return the store ids of token strings, adding unknown ones to the vocab.
+
+    The vocabulary table of a model only ever grows, so ids written in
+    earlier files stay valid. Jobs writing to the same model directory add
+    their tokens under a lock, to the table as last written by any of them.
+    """
+    load_vocab(model_dir)
+    ids = _vocabs[model_dir][1]
+
+    if any(tok not in ids for tok in tokens):
+        with lock_vocab(model_dir):
+            # the cached vocabulary is a prefix of the one on disk
+            path = get_vocab_path(model_dir)
+            size = pq.read_metadata(path).num_rows if os.path.exists(path) else 0
+            vocab = load_vocab(model_dir, size)
+            ids = _vocabs[model_dir][1]
+
+            new_tokens = [tok for tok in dict.fromkeys(tokens) if tok not in ids]
+            if new_tokens:
+                for tok in new_tokens:
+                    ids[tok] = len(vocab)
+                    vocab.append(tok)
+
+                with atomic_open(path, "wb") as f:
+                    pq.write_table(
+                        pa.table(
+                            {
+                                "id": pa.array(range(len(vocab)), pa.int32()),
+                                "token": pa.array(vocab, pa.string()),
+                            }
+                        ),
+                        f,
+                    )
+
+    return [ids[tok] for tok in tokens]
+
+
+def get_vocab_size(table):
+    """Return the vocabulary size needed to decode the ids of a logits table."""
+    size = 0
+    for name in ("token_id", "top_k_ids", "watch_ids"):
+        if name not in table.column_names:
+            continue
+        column = table.column(name)
+        if pa.types.is_list(column.type):
+            column = pc.list_flatten(column)
+        max_id = pc.max(column).as_py()
+        if max_id is not None:
+            size = max(size, max_id + 1)
+    return size
+
+
+def get_generated_text_path(logits_path):
+    """Return the generated text file matching a logits file."""
+    logits_dir, filename = os.path.split(logits_path)
+    filename = filename.replace("token_logits_", "generated_text_", 1)
+    filename = os.path.splitext(filename)[0] + ".txt"
+    return os.path.join(os.path.dirname(logits_dir), "gen", filename)
+
+
+def get_model_dir(logits_path):
+    """Return the model directory of a results/<model>/... logits file."""
+    path = os.path.normpath(logits_path)
+    # <model>/<level>/<text_type>/<task>/logits/<file>
+    for _ in range(5):
+        path = os.path.dirname(path)
+    return path
+
+
+def write_logits(path, records, text, model, level, text_type, gen_type, prompt_id):
+    """Write the records of a generated sequence as a Parquet file.
+
+    Token strings are stored as ids into the vocabulary table of the model,
+    and the generated text is kept in the file metadata so that the context
+    of each step can be rebuilt from its offset.
+    """
+    model_dir = get_model_dir(path)
+
+    # the tokens of a file are encoded at once, so that the vocabulary is
+    # written at most once per file
+    watch = records[0].get("watch", []) if records else []
+    tokens = [res["token"] for res in records]
+    tokens += [tk["token"] for res in records for tk in res["top_k"]]
+    # the same tokens are watched at every step
+    tokens += [w["token"] for w in watch]
+    ids = encode_tokens(model_dir, tokens)
+
+    token_ids = ids[: len(records)]
+    top_k_ids = []
+    start = len(records)
+    for res in records:
+        top_k_ids.append(ids[start : start + len(res["top_k"])])
+        start += len(res["top_k"])
+
+    watch_ids = [None] * len(records)
+    if records and "watch" in records[0]:
+        watch_ids = [ids[start:]] * len(records)
+
+    n = len(records)
+    table = pa.table(
+        {
+            "model": [model] * n,
+            "level": [level] * n,
+            "text_type": [text_type] * n,
+            "gen_type": [gen_type] * n,
+            "prompt_id": [prompt_id] * n,
+            "step": [res["step"] for res in records],
+            "token_id": token_ids,
+            "logprob": [res["logprob"] for res in records],
+            "rank": [res.get("rank") for res in records],
+            "offset": [res["offset"] for res in records],
+            "top_k_ids": top_k_ids,
+            "top_k_logprobs": [
+                [tk["logprob"] for tk in res["top_k"]] for res in records
+            ],
+            "watch_ids": watch_ids,
+            "watch_logprobs": [
+                [w["logprob"] for w in res["watch"]] if "watch" in res else None
+                for res in records
+            ],
+            "watch_ranks": [
+                [w["rank"] for w in res["watch"]] if "watch" in res else None
+                for res in records
+            ],
+        },
+        schema=LOGITS_SCHEMA.with_metadata({"text": text}),
+    )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_open(path, "wb") as f:
+        pq.write_table(table, f, compression="zstd")
+
+
+def get_column(table, name):
+    """Return a column of a logits table as a list."""
+    # files written before a column was added do not have it
+    if name not in table.column_names:
+        return [None] * table.num_rows
+    return table.column(name).to_pylist()
+
+
+def read_logits(path):
+    """Read a Parquet logits file back into JSONL-like records.
+
+    Like records loaded from JSONL, each record holds the generated text
+    along with the offset of its token in it.
+    """
+    table = pq.read_table(path)
+    text = table.schema.metadata.get(b"text", b"").decode("utf8")
+    vocab = load_vocab(get_model_dir(path), get_vocab_size(table))
+
+    records = []
+    for (
+        step,
+        token_id,
+        logprob,
+        rank,
+        offset,
+        top_k_ids,
+        top_k_logprobs,
+        watch_ids,
+        watch_logprobs,
+        watch_ranks,
+    ) in zip(
+        *(
+            get_column(table, name)
+            for name in (
+                "step",
+                "token_id",
+                "logprob",
+                "rank",
+                "offset",
+                "top_k_ids",
+                "top_k_logprobs",
+                "watch_ids",
+                "watch_logprobs",
+                "watch_ranks",
+            )
+        )
+    ):
+        record = {
+            "step": step,
+            "token": vocab[token_id],
+            "logprob": logprob,
+            "top_k": [
+                {"token": vocab[idx].replace("Ġ", ""), "logprob": lp}
+                for idx, lp in zip(top_k_ids, top_k_logprobs)
+            ],
+            "offset": offset,
+            "text": text,
+        }
+        if rank is not None:
+            record["rank"] = rank
+        if watch_ids is not None:
+            record["watch"] = [
+                {"token": vocab[idx], "logprob": lp, "rank": r}
+                for idx, lp, r in zip(watch_ids, watch_logprobs, watch_ranks)
+            ]
+        records.append(record)
+
+    return records
+
+
+def read_logits_columns(path, context=False):
+    """Read the columns of a Parquet logits file used by the analysis.
+
+    Returns per-step lists keyed like those of plot.read_log_file: only the
+    needed columns are read, and with context, every step gets the offset
+    of its token and the generated text, shared by all steps.
+    """
+    schema = pq.read_schema(path)
+    names = ["step", "token_id", "logprob", "rank", "top_k_ids", "top_k_logprobs"]
+    names += ["watch_ids", "watch_logprobs", "watch_ranks"]
+    if context:
+        names.append("offset")
+    table = pq.read_table(path, columns=[n for n in names if n in schema.names])
+    vocab = load_vocab(get_model_dir(path), get_vocab_size(table))
+
+    watch_ids = get_column(table, "watch_ids")
+    columns = {
+        "step": get_column(table, "step"),
+        "token": [vocab[idx] for idx in get_column(table, "token_id")],
+        "logprob": get_column(table, "logprob"),
+        "rank": get_column(table, "rank"),
+        "top_k_tokens": [
+            [vocab[idx].replace("Ġ", "") for idx in ids]
+            for ids in get_column(table, "top_k_ids")
+        ],
+        "top_k_logprobs": get_column(table, "top_k_logprobs"),
+        "watch_tokens": [
+            [vocab[idx] for idx in ids] if ids is not None else None
+            for ids in watch_ids
+        ],
+        "watch_logprobs": get_column(table, "watch_logprobs"),
+        "watch_ranks": get_column(table, "watch_ranks"),
+    }
+    if context:
+        text = schema.metadata.get(b"text", b"").decode("utf8")
+        columns["offset"] = get_column(table, "offset")
+        columns["text"] = [text] * table.num_rows
+
+    return columns
+
+
+def read_log_file(filename, context=False):
+    """Read the columns of a logits file, JSONL or Parquet, as per-step lists.
+
+    Only the fields used by the analysis are kept. With context, every step
+    also gets the offset of its token and the text of the file, a single
+    string shared by all its steps.
+    """
+    if filename.endswith(".parquet"):
+        return read_logits_columns(filename, context)
+
+    columns = {name: [] for name in LOG_COLUMNS}
+    offsets = []
+    text = None
+    with open(filename, encoding="utf8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            columns["step"].append(record["step"])
+            columns["token"].append(record["token"])
+            columns["logprob"].append(record["logprob"])
+            columns["rank"].append(record.get("rank"))
+            columns["top_k_tokens"].append([tk["token"] for tk in record["top_k"]])
+            columns["top_k_logprobs"].append([tk["logprob"] for tk in record["top_k"]])
+            watch = record.get("watch")
+            columns["watch_tokens"].append(
+                [w["token"] for w in watch] if watch is not None else None
+            )
+            columns["watch_logprobs"].append(
+                [w["logprob"] for w in watch] if watch is not None else None
+            )
+            columns["watch_ranks"].append(
+                [w["rank"] for w in watch] if watch is not None else None
+            )
+
+            if not context:
+                continue
+            if "context" in record:
+                offsets.append(len(record["context"]))
+                text = record["context"]
+            else:
+                offsets.append(record.get("offset", 0))
+
+    if context:
+        if text is None and offsets:
+            with open(get_generated_text_path(filename), encoding="utf8") as f:
+                text = f.read()
+        columns["offset"] = offsets
+        columns["text"] = [text] * len(offsets)
+
+    return columns
+
+
+def get_log_paths(folder):
+    """Return the logits files matching a glob pattern."""
+    # when a file exists in both formats, read the Parquet one
+    filenames = {}
+    for filename in sorted(glob.glob(folder)):
+        stem, ext = os.path.splitext(filename)
+        if ext == ".parquet" or (ext == ".jsonl" and stem not in filenames):
+            filenames[stem] = filename
+    return list(filenames.values())
+
+
+def load_log_files(folder, context=False, workers=None):
+    """Load the logits files matching a glob pattern as a DataFrame.
+
+    folder can also be a list of files. The DataFrame has one row per step,
+    with the columns of read_log_file and the index of its file in the
+    "files" attribute. Files are parsed in parallel by workers processes
+    (by default, one per core).
+    """
+    paths = get_log_paths(folder) if isinstance(folder, str) else list(folder)
+
+    if workers is None:
+        workers = os.cpu_count()
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            results = list(
+                executor.map(functools.partial(read_log_file, context=context), paths)
+            )
+    else:
+        results = [read_log_file(path, context) for path in paths]
+
+    columns = {name: [] for name in ["file"] + LOG_COLUMNS}
+    if context:
+        columns.update({"offset": [], "text": []})
+    for i, result in enumerate(results):
+        columns["file"].extend([i] * len(result["step"]))
+        for name, values in result.items():
+            columns[name].extend(values)
+
+    logs = pd.DataFrame(columns)
+    logs.attrs["files"] = paths
+    return logs
+
+
+def explode_lists(logs, columns):
+    """Flatten list columns of the step rows into one row per list element.
+
+    Returns a DataFrame with the index of the step of each element ("row"),
+    its position in the list ("pos") and the given columns; a null list has
+    no element.
+    """
+    lengths = np.fromiter(
+        (len(values) if values is not None else 0 for values in logs[columns[0]]),
+        dtype=np.int64,
+        count=len(logs),
+    )
+    rows = np.repeat(np.arange(len(logs)), lengths)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    exploded = {"row": rows, "pos": np.arange(len(rows)) - starts}
+    for name in columns:
+        exploded[name] = list(
+            itertools.chain.from_iterable(v for v in logs[name] if v is not None)
+        )
+    return pd.DataFrame(exploded)
+
+
+def normalize_tokens(tokens):
+    """Strip the word boundary markers of tokens, once per distinct token."""
+    codes, uniques = pd.factorize(pd.Series(tokens, dtype=object))
+    return pd.Series(uniques, dtype=object).str.strip("Ġ▁").to_numpy()[codes]
+
+
+def get_top_k_alternatives(logs, tokens=None, ranked=False):
+    """Return the top-k alternatives of every step, with normalized tokens.
+
+    Alternatives that only differ by their word boundary markers are merged
+    as in a dict: first position, last logprob. With ranked, each one gets
+    its rank among the merged alternatives of its step, by decreasing
+    logprob. With tokens, only the alternatives with these tokens are kept.
+    Returns a DataFrame with the row of the step, token, logprob and rank.
+    """
+    top_k = explode_lists(logs, ["top_k_tokens", "top_k_logprobs"])
+    top_k.columns = ["row", "pos", "token", "logprob"]
+    top_k["token"] = normalize_tokens(top_k["token"])
+    if not ranked:
+        if tokens is not None:
+            top_k = top_k[top_k["token"].isin(tokens)]
+        top_k = top_k.drop_duplicates(["row", "token"], keep="last")
+        return top_k.drop(columns="pos").assign(rank=None)
+
+    codes, uniques = pd.factorize(top_k["token"])
+    step_token = top_k["row"].to_numpy() * len(uniques) + codes
+    top_k["pos"] = top_k.groupby(step_token)["pos"].transform("first")
+    top_k = top_k[~pd.Series(step_token).duplicated(keep="last").to_numpy()]
+    top_k = top_k.iloc[np.lexsort((top_k["pos"], -top_k["logprob"], top_k["row"]))]
+
+    # rank of each token within its step, once sorted by logprob
+    rows = top_k["row"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    top_k = top_k.drop(columns="pos").assign(
+        rank=np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    )
+    if tokens is not None:
+        top_k = top_k[top_k["token"].isin(tokens)]
+    return top_k
+
+
+def get_watched_alternatives(logs, tokens=None):
+    """Return the watched tokens of every step, with normalized tokens.
+
+    Each variant of a watched word keeps its own logprob and rank; variants
+    with a null probability are left out. With tokens, only the watched
+    tokens among them are kept. Returns a DataFrame with the row of the
+    step, token, logprob and rank.
+    """
+    watch = explode_lists(logs, ["watch_tokens", "watch_logprobs", "watch_ranks"])
+    watch.columns = ["row", "pos", "token", "logprob", "rank"]
+    watch["token"] = normalize_tokens(watch["token"])
+    kept = watch["logprob"] != float("-inf")
+    if tokens is not None:
+        kept &= watch["token"].isin(tokens)
+    return watch[kept].drop(columns="pos")
+
+
+def parse_logits_path(path):
+    """Return the model, level, text_type, gen_type and prompt id of a file."""
+    parts = os.path.normpath(path).split(os.sep)
+    model, level, text_type, task = parts[-6:-2]
+    # <gen_type>_task, or <gen_type>_score_<source> for scored texts
+    gen_type = task.split("_", 1)[0]
+
+    filename = os.path.splitext(parts[-1])[0]
+    prompt_id = filename.removeprefix(f"token_logits_{model}_")
+    prompt_id = prompt_id.removesuffix(f"_{text_type}_{gen_type}")
+
+    return model, level, text_type, gen_type, prompt_id
+
+
+def convert_jsonl(path, remove=False):
+    """Convert a JSONL logits file into a Parquet file next to it."""
+    with open(path, encoding="utf8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    if records and "offset" not in records[0]:
+        # older files store the whole context of each step, which are all
+        # prefixes of the context of the last step
+        text = records[-1]["context"]
+        for record in records:
+            record["offset"] = len(record.pop("context"))
+    else:
+        with open(get_generated_text_path(path), encoding="utf8") as f:
+            text = f.read()
+
+    write_logits(
+        os.path.splitext(path)[0] + ".parquet",
+        records,
+        text,
+        *parse_logits_path(path),
+    )
+
+    if remove:
+        os.remove(path)
+
+
+def convert_tree(results_dir="results", remove=False):
+    """Convert every JSONL logits file of a results tree into Parquet."""
+    paths = sorted(glob.glob(os.path.join(results_dir, "*/*/*/*/logits/*.jsonl")))
+    for i, path in enumerate(paths):
+        print(f"[{i + 1}/{len(paths)}] Converting {path}")
+        convert_jsonl(path, remove)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert JSONL logits files into the Parquet logits store"
+    )
+    parser.add_argument(
+        "-r",
+        "--results_dir",
+        type=str,
+        default="results",
+        help="Results folder to convert (default: 'results')",
+    )
+    parser.add_argument(
+        "--remove",
+        action="store_true",
+        help="Remove the JSONL files once converted",
+    )
+
+    args = parser.parse_args()
+
+    convert_tree(args.results_dir, args.remove)